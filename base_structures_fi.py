@@ -2,13 +2,16 @@
 #
 # Module containing base structures for Finnish grammar.
 
+import re
+
 FRONT_VOWELS = ['ä', 'ö', 'y', 'Ä', 'Ö', 'Y']
 BACK_VOWELS = ['a', 'o', 'u', 'A', 'O', 'U']
 NEUTRAL_VOWELS = ['e', 'i', 'E', 'I']
 ALL_VOWELS = FRONT_VOWELS + BACK_VOWELS + NEUTRAL_VOWELS
+VOWEL_SET = frozenset(ALL_VOWELS)
 
 def is_vowel(c):
-    return c in ALL_VOWELS
+    return c in VOWEL_SET
 
 # We say that a word is a 'back word' if the first vowel we find
 # starting from the end is a back vowel. If the first vowel is a front
@@ -26,7 +29,9 @@ SY_INIT = 0            # Initial state of the current syllable
 SY_VOWEL = 1           # Found a vowel
 SY_END_OR_START_C = 2  # Found an end or start consonant
 
-# Split a Finnish word into syllables. This is a heuristic that
+# Split a Finnish word into syllables, one character at a time.
+# This is the reference for split_syllables below, which does the
+# same with a regular expression. This is a heuristic that
 # should hopefully be good enough for using it to apply kpt
 # rules. It is clearly not an exact set of rules, which are
 # complicated:
@@ -37,7 +42,7 @@ SY_END_OR_START_C = 2  # Found an end or start consonant
 # attribute the first consonant to the previous syllable.
 # Returns a list of syllables that when concatenated
 # in order make up the original word.
-def split_syllables(word):
+def split_syllables_old(word):
     syllables = []
     s = ''
     current_state = SY_INIT
@@ -86,3 +91,18 @@ def split_syllables(word):
     if s:
         syllables.append(s)
     return syllables
+
+# The syllables found by split_syllables_old: a syllable is any
+# consonants up to its vowels, the vowels, and a consonant after
+# them unless that one starts the next syllable, i.e. is followed
+# by a vowel. A word without any (more) vowels is a single syllable.
+VOWEL_CLASS = '[' + ''.join(ALL_VOWELS) + ']'
+CONSONANT_CLASS = '[^' + ''.join(ALL_VOWELS) + ']'
+SYLLABLE = re.compile(r'{c}*{v}+(?:{c}(?!{v}))?|{c}+'.format(
+    v=VOWEL_CLASS, c=CONSONANT_CLASS))
+
+# Split a Finnish word into syllables, see split_syllables_old.
+# Returns a list of syllables that when concatenated
+# in order make up the original word.
+def split_syllables(word):
+    return SYLLABLE.findall(word)
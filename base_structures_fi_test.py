@@ -3,6 +3,7 @@
 #
 # Test cases for Finnish grammar rules.
 
+import random
 import unittest
 import base_structures_fi as base_fi
 
@@ -37,6 +38,17 @@ class TestSyllableSplit(unittest.TestCase):
         for p in golden_splits:
             self.assertGreaterEqual(set(base_fi.split_syllables(p[0])),
                                     set(p[1]))
+
+    # split_syllables splits like split_syllables_old, which
+    # also covers upper case, non-letters and words without vowels.
+    def test_syllables_old(self):
+        rnd = random.Random(0)
+        letters = 'aeiouyäöAEIOUYÄÖkptlmnrsvhjdgKT- '
+        for _ in range(100000):
+            word = ''.join(rnd.choice(letters)
+                           for _ in range(rnd.randint(0, 12)))
+            self.assertEqual(base_fi.split_syllables(word),
+                             base_fi.split_syllables_old(word), word)
             
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Benchmarks for building dictionaries with tab2opf.
+#
+# Generates a synthetic tab file, either Finnish words for the
+# inflection rules in grammar_fi or dict.cc style German terms
+# for the dictcc module, and measures the time and peak memory of
+# the build steps separately and end to end:
+#
+#   python3 benchmark.py --lines 100000 --flavor fi -o fi.json
+#   python3 benchmark.py --compare old.json new.json
+#
+# The results are written as JSON, so they can be compared
+# between revisions.
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import base_structures_fi
+import grammar_fi
+import tab2opf
+
+# Letters used for the synthetic Finnish words
+CONSONANTS = 'kptlmnrsvhj'
+BACK_VOWELS = 'aou'
+FRONT_VOWELS = 'äöy'
+
+# Infinitive suffixes by verbityyppi, vt1 just doubles the
+# last vowel of the stem.
+VERB_SUFFIXES = ['', 'da', 'lla', 'sta', 'ata', 'ita', 'eta']
+# Noun suffixes for the different sanatyypit
+NOUN_SUFFIXES = ['', '', 'e', 'nen', 'si', 'i']
+
+# Building blocks of the synthetic dict.cc terms
+GERMAN_ARTICLES = ['der', 'die', 'das']
+GERMAN_GENDERS = ['{m}', '{f}', '{n}', '{pl}']
+GERMAN_PREFIXES = ['etw.', 'jdn.', 'sich', 'mit jdm.', 'an etw.']
+GERMAN_EXTRAS = ['', '', '[ugs.]', '(von etw.)', '[fig.]']
+
+# A random Finnish stem with vowel harmony, e.g. 'kattu'
+def finnish_stem(rnd):
+    vowels = BACK_VOWELS if rnd.random() < 0.6 else FRONT_VOWELS
+    return (rnd.choice(CONSONANTS) + rnd.choice(vowels) +
+            rnd.choice(['', 'k', 't', 'p', 'n', 'l', 's']) +
+            rnd.choice(CONSONANTS) + rnd.choice(vowels + 'ei'))
+
+def finnish_word(rnd, word_type):
+    stem = finnish_stem(rnd)
+    if word_type == 'verb':
+        suffix = rnd.choice(VERB_SUFFIXES)
+        if suffix == '':
+            return stem + ('a' if stem[-1] in BACK_VOWELS + 'ei' else 'ä')
+        return stem[:-1] + suffix
+    return stem + rnd.choice(NOUN_SUFFIXES)
+
+def german_term(rnd, word_type):
+    word = ''.join(rnd.choice(CONSONANTS) + rnd.choice('aeiou')
+                   for _ in range(rnd.randint(2, 4)))
+    if word_type == 'noun':
+        return '{} {} {} {}'.format(rnd.choice(GERMAN_ARTICLES),
+                                    word.capitalize(),
+                                    rnd.choice(GERMAN_GENDERS),
+                                    rnd.choice(GERMAN_EXTRAS)).strip()
+    if word_type == 'verb':
+        return '{} {}en {}'.format(rnd.choice(GERMAN_PREFIXES), word,
+                                   rnd.choice(GERMAN_EXTRAS)).strip()
+    return word + 'ig'
+
+# Write a synthetic tab file of lines lines to fname.
+#  flavor:     'fi' for Finnish words, 'dictcc' for dict.cc terms
+#  mix:        relative frequency of nouns, verbs and adjectives
+#  vocabulary: number of distinct words, every word appears
+#              lines/vocabulary times on average, like the
+#              repeated headwords of a real dictionary
+def generate(fname, lines, flavor='fi', mix=(5, 3, 2), vocabulary=None,
+             seed=0):
+    rnd = random.Random(seed)
+    word_types = ['noun', 'verb', 'adj']
+    make = finnish_word if flavor == 'fi' else german_term
+    if vocabulary is None:
+        vocabulary = max(1, lines // 2)
+    words = []
+    for _ in range(vocabulary):
+        word_type = rnd.choices(word_types, weights=mix)[0]
+        words.append((make(rnd, word_type), word_type))
+
+    with open(fname, 'w', encoding='utf-8') as to:
+        to.write('# synthetic {} dictionary, {} lines\n'.format(flavor, lines))
+        for i in range(lines):
+            word, word_type = rnd.choice(words)
+            to.write('{}\tmeaning {} of {}\t{}\n'.format(word, i, word,
+                                                         word_type))
+
+# Run fn(*args) and return its result together with the wall
+# time in seconds and, with memory, the peak of memory allocated
+# by python in bytes while it ran. Tracing allocations slows
+# python down considerably, so run_benchmarks takes the timings
+# and the memory peaks in separate runs.
+# Only the current process is measured, not worker processes.
+def measure(fn, *args, memory=True):
+    if memory: tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn(*args)
+    finally:
+        stats = {'wall': time.perf_counter() - start, 'peak_bytes': None}
+        if memory:
+            stats['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return result, stats
+
+def bench_getinflections(fname, memory=True):
+    words = []
+    with open(fname, encoding='utf-8') as fr:
+        for r in filter(tab2opf.inclline, fr):
+            term, _, word_type = r.rstrip('\n').split('\t')
+            words.append((term.lower(), word_type))
+    def run():
+        for word, word_type in words:
+            grammar_fi.getinflections(word, word_type)
+    return measure(run, memory=memory)[1]
+
+# Micro-benchmark of split_syllables against the character
+# by character split_syllables_old on the words of fname,
+# repeat times over to get measurable timings.
+def bench_split_syllables(fname, memory=True, repeat=10):
+    with open(fname, encoding='utf-8') as fr:
+        words = [r.split('\t', 1)[0].lower()
+                 for r in filter(tab2opf.inclline, fr)] * repeat
+    results = {}
+    for name in ['split_syllables', 'split_syllables_old']:
+        split = getattr(base_structures_fi, name)
+        def run():
+            for word in words:
+                split(word)
+        results[name] = measure(run, memory=memory)[1]
+    results['split_syllables']['speedup'] = (
+        results['split_syllables_old']['wall'] /
+        results['split_syllables']['wall'])
+    return results
+
+# Benchmark the build steps of the tab file fname with the
+# builder configuration config separately and end to end.
+def bench_build(config, memory=True):
+    results = {}
+    builder = tab2opf.Builder(config)
+    defns, results['readkeys'] = measure(builder.readkeys, memory=memory)
+    ndicts, results['writekeys'] = measure(builder.writekeys, defns,
+                                           config.name, memory=memory)
+    _, results['writeopf'] = measure(builder.writeopf, ndicts, config.name,
+                                     memory=memory)
+    del defns
+    _, results['build'] = measure(tab2opf.build, config, memory=memory)
+    return results
+
+# The current git revision, if any
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(args):
+    module = {'fi': 'grammar_fi', 'dictcc': 'dictcc'}[args.flavor]
+    with tempfile.TemporaryDirectory(prefix='tab2opf-bench') as tmpdir:
+        fname = os.path.join(tmpdir, 'bench.tab')
+        generate(fname, args.lines, args.flavor, args.mix, args.vocabulary,
+                 args.seed)
+        config = tab2opf.Config(fname, module=module, jobs=args.jobs,
+                                outdir=tmpdir)
+        results = bench_build(config, memory=False)
+        results['getinflections'] = bench_getinflections(fname, memory=False)
+        results.update(bench_split_syllables(fname, memory=False))
+        if args.memory:
+            peaks = bench_build(config)
+            peaks['getinflections'] = bench_getinflections(fname)
+            peaks.update(bench_split_syllables(fname))
+            for step, peak in peaks.items():
+                results[step]['peak_bytes'] = peak['peak_bytes']
+    for step in ['readkeys', 'build', 'getinflections']:
+        results[step]['lines_per_second'] = args.lines / results[step]['wall']
+    return {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'flavor': args.flavor,
+        'lines': args.lines,
+        'mix': args.mix,
+        'jobs': args.jobs,
+        'memory': args.memory,
+        'results': results,
+    }
+
+# Print the change in wall time and memory of every step
+# from the results in old to the ones in new.
+def compare(old, new):
+    print('{:16} {:>10} {:>10} {:>8} {:>12} {:>12}'.format(
+        'step', 'old s', 'new s', 'speedup', 'old MiB', 'new MiB'))
+    mib = lambda b: '{:12.1f}'.format(b / 2**20) if b is not None else ' '*12
+    for step, n in new['results'].items():
+        o = old['results'].get(step)
+        if o is None: continue
+        print('{:16} {:10.3f} {:10.3f} {:8.2f} {} {}'.format(
+            step, o['wall'], n['wall'], o['wall'] / n['wall'],
+            mib(o['peak_bytes']), mib(n['peak_bytes'])))
+
+def parseargs(argv=None):
+    parser = argparse.ArgumentParser("benchmark")
+    parser.add_argument("--lines", type=int, default=20000,
+                        help="Number of lines of the synthetic dictionary")
+    parser.add_argument("--flavor", choices=['fi', 'dictcc'], default='fi',
+                        help="Finnish words or dict.cc German terms")
+    parser.add_argument("--mix", type=int, nargs=3, default=[5, 3, 2],
+                        metavar=('NOUNS', 'VERBS', 'ADJS'),
+                        help="Relative frequency of the word types")
+    parser.add_argument("--vocabulary", type=int,
+                        help="Number of distinct words (lines/2 by default)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="Only take timings, without the runs tracing "
+                        "memory")
+    parser.add_argument("-o", "--output", help="Write the results to this "
+                        "JSON file instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=('OLD', 'NEW'),
+                        help="Compare two result files")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseargs(argv)
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            compare(json.load(old), json.load(new))
+        return
+
+    # The build steps print their progress, keep stdout for the results.
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        report = run_benchmarks(args)
+    finally:
+        sys.stdout = stdout
+    if args.output:
+        with open(args.output, 'w') as to:
+            json.dump(report, to, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+if __name__ == '__main__':
+    main()
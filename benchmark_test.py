@@ -0,0 +1,45 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Test cases for the benchmark dictionary generator.
+
+import os
+import tempfile
+import unittest
+import benchmark
+import tab2opf
+
+class TestGenerate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def test_generate(self):
+        for flavor, module in [('fi', 'grammar_fi'), ('dictcc', 'dictcc')]:
+            fname = os.path.join(self.tmpdir.name, flavor + '.tab')
+            benchmark.generate(fname, 200, flavor, vocabulary=50)
+            config = tab2opf.Config(fname, module=module,
+                                    outdir=self.tmpdir.name)
+            defns = tab2opf.Builder(config).readkeys()
+            self.assertEqual(sum(len(d) for d in defns.values()), 200)
+            self.assertLessEqual(len(defns), 50)
+
+    def test_deterministic(self):
+        fnames = [os.path.join(self.tmpdir.name, str(i)) for i in range(2)]
+        for fname in fnames:
+            benchmark.generate(fname, 100, seed=3)
+        with open(fnames[0]) as a, open(fnames[1]) as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_split_syllables(self):
+        fname = os.path.join(self.tmpdir.name, 'fi.tab')
+        benchmark.generate(fname, 100)
+        results = benchmark.bench_split_syllables(fname, memory=False,
+                                                  repeat=1)
+        self.assertEqual(set(results),
+                         {'split_syllables', 'split_syllables_old'})
+        self.assertGreater(results['split_syllables']['speedup'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
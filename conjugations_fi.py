@@ -3,6 +3,9 @@
 # Module containing Finnish grammar rules to generate
 # conjugations from basic forms (verbs in infinitive etc.).
 
+import collections
+from functools import cached_property
+
 import base_structures_fi as base_fi
 import kpt_fi
 
@@ -27,18 +30,26 @@ def is_double_3ps(verb):
 #                 '-': Leave the vartalo unmodified
 #  vowel_group: Configure vokaaliharmonia by specifying either
 #               'a' or 'ä' here. This is used for the 3pp ending.
-def conjugate_present(inf, vartalo, connector, strength_map, vowel_group):
-    double_3ps = is_double_3ps(inf)
-    endings = ['n', 't', (vartalo+connector)[-1] if double_3ps else '',
+#  analysis: The VerbAnalysis of inf if there is one, which
+#            provides the heikko and vahva forms of vartalo.
+def conjugate_present(inf, vartalo, connector, strength_map, vowel_group,
+                      analysis=None):
+    if analysis is None:
+        analysis = VerbAnalysis(inf, vartalo)
+    endings = ['n', 't', (vartalo+connector)[-1] if analysis.double_3ps else '',
                'mme', 'tte', 'v' + vowel_group + 't']
+    # The vartalo for each letter of strength_map
+    stems = {'-': vartalo}
+    if 'h' in strength_map:
+        stems['h'] = analysis.heikko
+    if 'v' in strength_map:
+        stems['v'] = analysis.vahva
     conjugations = []
     for i in range(0, len(endings)):
         conjugations.append(
             ('{x}p{m} present'.format(x=i % 3 + 1,
                                       m='s' if i < 3 else 'p'),
-             (kpt_fi.apply_kpt_vaihtelu(vartalo) if strength_map[i]=='h'
-             else (kpt_fi.apply_inverse_kpt_vaihtelu(vartalo) if strength_map[i]=='v'
-                   else vartalo)) + connector + endings[i]))
+             stems[strength_map[i]] + connector + endings[i]))
     return conjugations
 
 # Return the verbityyppi of word as a number between 1 and 6.
@@ -72,89 +83,174 @@ def get_verbityyppi(word):
     return 0
 
 # Return the vartalo of a word without any kpt changes.
-def get_vartalo(word):
-    vt = get_verbityyppi(word)
+# vt is the verbityyppi of word, if already known.
+def get_vartalo(word, vt=None):
+    if vt is None:
+        vt = get_verbityyppi(word)
     if vt == 1:
         # Remove single character suffix.
         return word[:-1]
     return word[:-2]
 
+# Some vt1 verbs build the imperfekti like vt4 verbs.
+V1_EXCEPTIONS = ['huutaa', 'kieltää', 'kääntää', 'lentää', 'löytää',
+                 'piirtää', 'pyytää', 'rakentaa', 'siirtä', 'tietää',
+                 'tuntea', 'työntää', 'ymmärtää']
+
+# The number of characters of the vt1 present tense stem replaced
+# by 'si' in imperfekti (xa/xä -> si), for V1_EXCEPTIONS only.
+def get_si_imperfekti_vt1(word):
+    return 2 if word in V1_EXCEPTIONS else 0
+
+# The first character(s) of the negatiivinen imperfekti suffix of
+# vt3 verbs: 's' for s-ta/s-tä, otherwise the l/n/r before the a/ä.
+def get_negative_suffix_vt3(word):
+    return 's' if word[-3:-1] == 'st' else word[-2]
+
+# How the verbs of a verbityyppi are conjugated. Each value is
+# either the same for all verbs of the verbityyppi or a function
+# computing it from the infinitive:
+#  connector:      See conjugate_present.
+#  strength_map:   See conjugate_present.
+#  double_3ps:     See is_double_3ps.
+#  si_imperfekti:  The number of characters at the end of the
+#                  present tense stem that are replaced by 'si'
+#                  in imperfekti, or 0 if none are.
+#  negative_suffix: The characters between the vartalo and the
+#                  ending of negatiivinen imperfekti.
+Verbiluokka = collections.namedtuple(
+    'Verbiluokka', ['connector', 'strength_map', 'double_3ps',
+                    'si_imperfekti', 'negative_suffix'])
+
+# The verbiluokka of every verbityyppi (see get_verbityyppi).
+# Words of verbityyppi 0 aren't verbs, so they have no present
+# tense and nothing derived from it.
+VERBITYYPIT = {
+    0: Verbiluokka(None, None, is_double_3ps, 0, 'n'),
+    1: Verbiluokka('', 'hh-hh-', True, get_si_imperfekti_vt1, 'n'),
+    2: Verbiluokka('', '------', False, 0, 'n'),
+    3: Verbiluokka('e', 'vvvvvv', True, 0, get_negative_suffix_vt3),
+    # The connector is the a/ä of the infinitive, e.g. halu-ta -> halu-a-n.
+    4: Verbiluokka(lambda word: word[-1], 'vvvvvv', is_double_3ps, 1, 'nn'),
+    5: Verbiluokka('tse', '------', True, 0, 'nn'),
+    6: Verbiluokka('ne', 'vvvvvv', True, 0, 'nn'),
+}
+
+# Split every verbiluokka into the values that are the same for all
+# of its verbs and the functions computing the others, so that
+# analyzing a verb only has to call the latter.
+def compile_verbityypit(verbityypit):
+    compiled = {}
+    for vt, luokka in verbityypit.items():
+        values = luokka._asdict()
+        functions = [(name, value) for name, value in values.items()
+                     if callable(value)]
+        for name, _ in functions:
+            del values[name]
+        compiled[vt] = (values, functions)
+    return compiled
+
+COMPILED_VERBITYYPIT = compile_verbityypit(VERBITYYPIT)
+
+# Everything the conjugation rules need to know about a verb,
+# worked out once per word and shared by the present tense,
+# imperfekti and negative forms:
+#  word:        The infinitive.
+#  verbityyppi: See get_verbityyppi.
+#  vartalo:     See get_vartalo, unless given.
+#  back:        Whether word is a back word (vokaaliharmonia).
+#  heikko:      The vartalo after kpt-vaihtelu.
+#  vahva:       The vartalo after inverse kpt-vaihtelu.
+# and the values of the Verbiluokka of the verbityyppi for word.
+# heikko and vahva are only computed when used, as most
+# verbityyppit only need one of them (or neither).
+class VerbAnalysis:
+    def __init__(self, word, vartalo=None):
+        self.word = word
+        self.verbityyppi = get_verbityyppi(word)
+        if vartalo is None:
+            vartalo = get_vartalo(word, self.verbityyppi)
+        self.vartalo = vartalo
+        values, functions = COMPILED_VERBITYYPIT[self.verbityyppi]
+        self.__dict__.update(values)
+        for name, function in functions:
+            setattr(self, name, function(word))
+        self.back = base_fi.is_back_word(word)
+        self.split = {}
+
+    @cached_property
+    def heikko(self):
+        return kpt_fi.apply_kpt_vaihtelu(self.vartalo)
+
+    @cached_property
+    def vahva(self):
+        return kpt_fi.apply_inverse_kpt_vaihtelu(self.vartalo)
+
+    # The syllables of form, which is split only once
+    # however often it is asked for
+    def syllables(self, form):
+        if form not in self.split:
+            self.split[form] = base_fi.split_syllables(form)
+        return list(self.split[form])
+
+# Conjugate word in the present tense by the rules of its
+# verbityyppi.
+def conjugate_verbiluokka(word, analysis):
+    if analysis.verbityyppi == 0:
+        return []
+    return conjugate_present(word, analysis.vartalo, analysis.connector,
+                             analysis.strength_map, vowel_group=word[-1],
+                             analysis=analysis)
+
+# Apply the conjugation rules of verbityyppi vt if word is of
+# that type. Otherwise, returns an empty array.
+def apply_present_verbityyppi(word, vt, analysis=None):
+    analysis = analysis or VerbAnalysis(word)
+    if analysis.verbityyppi != vt:
+        return []
+    return conjugate_verbiluokka(word, analysis)
+
 # Apply vt1 conjugation rules if applicable. Otherwise,
 # returns an empty array.
-def apply_present_vt1(word):
-    if get_verbityyppi(word) != 1:
-        return []
-    vartalo = get_vartalo(word)
-    return conjugate_present(word, vartalo, connector='',
-                             strength_map='hh-hh-',
-                             vowel_group=word[-1])
+def apply_present_vt1(word, analysis=None):
+    return apply_present_verbityyppi(word, 1, analysis)
 
 # Apply vt2 conjugation rules if applicable. Otherwise,
 # returns an empty array.
-def apply_present_vt2(word):
-    if get_verbityyppi(word) != 2:
-        return []
-    vartalo = get_vartalo(word)
-    return conjugate_present(word, vartalo, connector='',
-                             strength_map='------',
-                             vowel_group=word[-1])
+def apply_present_vt2(word, analysis=None):
+    return apply_present_verbityyppi(word, 2, analysis)
 
 # Apply vt3 conjugation rules if applicable. Otherwise,
 # returns an empty array.
-def apply_present_vt3(word):
-    if get_verbityyppi(word) != 3:
-        return []
-    vartalo = get_vartalo(word)
-    return conjugate_present(word, vartalo, connector='e',
-                             strength_map='vvvvvv',
-                             vowel_group=word[-1])
+def apply_present_vt3(word, analysis=None):
+    return apply_present_verbityyppi(word, 3, analysis)
 
 # Apply vt4 conjugation rules if applicable. Otherwise,
 # returns an empty array.
-def apply_present_vt4(word):
-    if get_verbityyppi(word) != 4:
-        return []
-
-    vartalo = get_vartalo(word)    
-    return conjugate_present(word, vartalo, connector=word[-1],
-                             strength_map='vvvvvv',
-                             vowel_group=word[-1])
+def apply_present_vt4(word, analysis=None):
+    return apply_present_verbityyppi(word, 4, analysis)
 
 # Apply vt5 conjugation rules if applicable. Otherwise,
 # returns an empty array.
-def apply_present_vt5(word):
-    if get_verbityyppi(word) != 5:
-        return []
-    
-    vartalo = get_vartalo(word)
-    return conjugate_present(word, vartalo, connector='tse',
-                             strength_map='------',
-                             vowel_group=word[-1])
+def apply_present_vt5(word, analysis=None):
+    return apply_present_verbityyppi(word, 5, analysis)
 
 # Apply vt6 conjugation rules if applicable. Otherwise,
 # returns an empty array.
-def apply_present_vt6(word):
-    if get_verbityyppi(word) != 6:
-        return []
-    
-    vartalo = get_vartalo(word)
-    return conjugate_present(word, vartalo, connector='ne',
-                             strength_map='vvvvvv', vowel_group=word[-1])
+def apply_present_vt6(word, analysis=None):
+    return apply_present_verbityyppi(word, 6, analysis)
 
 # Conjugate a verb in the present tense. This function internally
 # detects the correct verbityyppi (vt1 - vt6) and applies the corresponding
 # rules.
-def apply_present_tense(word):
-    return (apply_present_vt1(word) +
-            apply_present_vt2(word) +
-            apply_present_vt3(word) +
-            apply_present_vt4(word) +
-            apply_present_vt5(word) +
-            apply_present_vt6(word))
+# The apply_* functions take the VerbAnalysis of word if the
+# caller has one, otherwise they analyze the word themselves.
+def apply_present_tense(word, analysis=None):
+    return conjugate_verbiluokka(word, analysis or VerbAnalysis(word))
 
 # Expects the present tense conjugation in c, and applies a transform
 # to imperfekti.
-def apply_imperfekti_add_i_cases(verb, c):
+def apply_imperfekti_add_i_cases(verb, c, analysis=None):
     last_vowel = c[0][-2]
     # We insert an i after the last vowel if it is o/ö/u/y and
     # it is not doubled.
@@ -164,7 +260,8 @@ def apply_imperfekti_add_i_cases(verb, c):
 
     endings = ['n', 't', '', 'mme', 'tte', 'v' + c[5][-2] + 't']
     imperfekti = []
-    num_3ps = 2 if is_double_3ps(verb) else 1
+    analysis = analysis or VerbAnalysis(verb)
+    num_3ps = 2 if analysis.double_3ps else 1
     
     for i in range(0, 6):
         imperfekti.append(
@@ -177,7 +274,7 @@ def apply_imperfekti_add_i_cases(verb, c):
 
 # Expects the present tense conjugation in c, and applies a transform
 # to imperfekti.
-def apply_imperfekti_replace_by_i_cases(verb, c):    
+def apply_imperfekti_replace_by_i_cases(verb, c, analysis=None):    
     last_vowel = c[0][-2]
     # We replace the last vowel by i if it is a/ä/e/i or
     # if it is doubled.
@@ -187,7 +284,8 @@ def apply_imperfekti_replace_by_i_cases(verb, c):
 
     endings = ['n', 't', '', 'mme', 'tte', 'v' + c[5][-2] + 't']
     imperfekti = []
-    num_3ps = 2 if is_double_3ps(verb) else 1
+    analysis = analysis or VerbAnalysis(verb)
+    num_3ps = 2 if analysis.double_3ps else 1
     
     for i in range(0, 6):
         imperfekti.append(
@@ -198,50 +296,51 @@ def apply_imperfekti_replace_by_i_cases(verb, c):
     
     return imperfekti
 
+# Check for ie->ei/yö->öi/uo->oi transformations.
+IMPERFEKTI_REPLACEMENTS = {'ie': 'ei', 'yö' : 'öi', 'uo' : 'oi'}
+
 # Conjugate a verb in imperfekti. This function is based on present tense
 # conjugations and doesn't care much about verbityyppit (with exceptions).
-def apply_imperfekti(word):
+#  present: The result of apply_present_tense(word), if already known.
+def apply_imperfekti(word, analysis=None, present=None):
+    analysis = analysis or VerbAnalysis(word)
+    if present is None:
+        present = apply_present_tense(word, analysis)
     # Start with the present tense and apply a set of transformation rules.
-    c = [w[1] for w in apply_present_tense(word)]
+    c = [w[1] for w in present]
     if not c:
         print("Doesn't seem to be a verb: {word}".format(word=word))
         return []
 
     # Check for ie->ei/yö->öi/uo->oi transformations.
     vv = c[0][-3:-1]
-    replacements = {'ie': 'ei', 'yö' : 'öi', 'uo' : 'oi'}
-    if vv in replacements.keys():
+    if vv in IMPERFEKTI_REPLACEMENTS:
         # Reverse the vowels and their replacement
-        rev_rep = replacements[vv][::-1]
+        rev_rep = IMPERFEKTI_REPLACEMENTS[vv][::-1]
         rev_vv = vv[::-1]
         for i in range(0, len(c)):
             c[i] = c[i][::-1].replace(rev_vv, rev_rep, 1)[::-1]
 
-    # Some vt1 verbs build the imperfekti like vt4 verbs.
-    v1_exception_list = ['huutaa', 'kieltää', 'kääntää', 'lentää', 'löytää',
-                         'piirtää', 'pyytää', 'rakentaa', 'siirtä', 'tietää',
-                         'tuntea', 'työntää', 'ymmärtää']
-
-    vt = get_verbityyppi(word)
-    if vt == 4 or (vt == 1 and word in v1_exception_list):
+    n = analysis.si_imperfekti
+    if n:
         # a/ä -> si for vt 4 or xa/xä -> si when in v1_exception_list
-        len_stem = len(c[0]) - (2 if vt == 4 else 3)
+        len_stem = len(c[0]) - 1 - n
         for i in range(0, len(c)):
-            c[i] = c[i][:len_stem] + 'si' + c[i][len_stem + (1 if vt == 4 else 2):]
+            c[i] = c[i][:len_stem] + 'si' + c[i][len_stem + n:]
             
     # Check for a->o transformation. This happens as the last transformation,
     # because otherwise it might break some of the ones above.
-    syllables = base_fi.split_syllables(c[2])
+    syllables = analysis.syllables(c[2])
     # kpt-vaihtelu might collapse the second syllable into the first one.
     # If so, the replacement has to happen for the last 'a' of the first
     # syllable.
-    has_collapsed_syllables = len(base_fi.split_syllables(c[0])) < len(syllables)
+    has_collapsed_syllables = len(analysis.syllables(c[0])) < len(syllables)
 
     if len(syllables) == 2 and 'a' in syllables[0] and 'a' in syllables[1]:
         for i in range(0, len(c)):
             # Replace a->o in the second syllable
             # (the suffix might have generated more).
-            s = base_fi.split_syllables(c[i])
+            s = analysis.syllables(c[i])
             # We have collapsed syllables in the heikko form, but that doesn't matter
             # for 3ps and 3pp, which are always vahva.
             rep_index = 0 if (has_collapsed_syllables and i != 2 and i != 5) else 1
@@ -255,24 +354,15 @@ def apply_imperfekti(word):
                 s[rep_index] = s[rep_index][::-1].replace('a', 'o', 1)[::-1]
             c[i] = "".join(s)
             
-    return (apply_imperfekti_add_i_cases(word, c) +
-            apply_imperfekti_replace_by_i_cases(word, c))
+    return (apply_imperfekti_add_i_cases(word, c, analysis) +
+            apply_imperfekti_replace_by_i_cases(word, c, analysis))
 
 # Produce negatiivinen imperfekti participles.
-def apply_negatiivinen_imperfekti(word):
-    vartalo = get_vartalo(word)
-    suffix_vowel = 'u' if base_fi.is_back_word(word) else 'y'
-    vt = get_verbityyppi(word)
-    # We default to a 'n' as first character, as is the case for
-    # vt 1 + 2 + some of vt 3.
-    start_suffix = 'n'
-    if vt == 3:
-        if len(word) > 2 and word[-3:-1] == 'st':
-            start_suffix = 's'
-        elif len(word) > 1:
-            start_suffix = word[-2]
-    elif vt > 3:
-        start_suffix = 'nn'
+def apply_negatiivinen_imperfekti(word, analysis=None):
+    analysis = analysis or VerbAnalysis(word)
+    vartalo = analysis.vartalo
+    suffix_vowel = 'u' if analysis.back else 'y'
+    start_suffix = analysis.negative_suffix
     
     result = [
         ('negatiivinen imperfekti', vartalo + start_suffix + suffix_vowel + 't'),
@@ -281,7 +371,10 @@ def apply_negatiivinen_imperfekti(word):
     return result
 
 # Produce conjugations and other inflections of the specified verb.
+# The word is analyzed once for all of them.
 def get_conjugations(word):
-    return (apply_present_tense(word) +
-            apply_imperfekti(word) +
-            apply_negatiivinen_imperfekti(word))
+    analysis = VerbAnalysis(word)
+    present = apply_present_tense(word, analysis)
+    return (present +
+            apply_imperfekti(word, analysis, present) +
+            apply_negatiivinen_imperfekti(word, analysis))
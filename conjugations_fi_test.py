@@ -285,6 +285,52 @@ class TestVTRules(unittest.TestCase):
         for w in golden_conjugations:
             self.assertGreaterEqual(set(co_fi.apply_negatiivinen_imperfekti(w[0])), set(w[1]))
 
+    def test_verb_analysis(self):
+        a = co_fi.VerbAnalysis('antaa')
+        self.assertEqual(a.verbityyppi, 1)
+        self.assertEqual(a.vartalo, 'anta')
+        self.assertEqual(a.heikko, 'anna')
+        self.assertEqual(a.vahva, 'antta')
+        self.assertTrue(a.back)
+        # Sharing the analysis doesn't change any forms
+        for word in ['antaa', 'syödä', 'tulla', 'osata', 'tarvita', 'vähetä',
+                     'kieltää', 'juoda']:
+            a = co_fi.VerbAnalysis(word)
+            present = co_fi.apply_present_tense(word, a)
+            self.assertEqual(present, co_fi.apply_present_tense(word))
+            self.assertEqual(co_fi.apply_imperfekti(word, a, present),
+                             co_fi.apply_imperfekti(word))
+            self.assertEqual(co_fi.get_conjugations(word),
+                             present + co_fi.apply_imperfekti(word) +
+                             co_fi.apply_negatiivinen_imperfekti(word))
+
+    def test_verbityypit(self):
+        golden_verbiluokat = [
+            # (word, verbityyppi, connector, double_3ps, si_imperfekti,
+            #  negative_suffix)
+            ('antaa', 1, '', True, 0, 'n'),
+            ('ymmärtää', 1, '', True, 2, 'n'),
+            ('syödä', 2, '', False, 0, 'n'),
+            ('tulla', 3, 'e', True, 0, 'l'),
+            ('nousta', 3, 'e', True, 0, 's'),
+            ('haluta', 4, 'a', True, 1, 'nn'),
+            ('osata', 4, 'a', False, 1, 'nn'),
+            ('tarvita', 5, 'tse', True, 0, 'nn'),
+            ('vähetä', 6, 'ne', True, 0, 'nn'),
+            ('talo', 0, None, True, 0, 'n'),
+        ]
+        for word, vt, connector, double_3ps, si, negative in golden_verbiluokat:
+            a = co_fi.VerbAnalysis(word)
+            self.assertEqual((a.verbityyppi, a.connector, a.double_3ps,
+                              a.si_imperfekti, a.negative_suffix),
+                             (vt, connector, double_3ps, si, negative), word)
+            # Only the apply_present_vtN of its own verbityyppi
+            # conjugates a word.
+            for n in range(1, 7):
+                present = getattr(co_fi, 'apply_present_vt%d' % n)(word)
+                self.assertEqual(present, co_fi.apply_present_tense(word)
+                                 if n == vt else [])
+
         
             
 if __name__ == '__main__':
@@ -3,6 +3,8 @@
 # Module containing Finnish grammar rules to generate
 # declensions from from perusmuoto substantiivi forms
 
+import collections
+
 import base_structures_fi as base_fi
 import kpt_fi
 
@@ -31,36 +33,103 @@ def get_gen_st_si(word):
     # Replace the -si suffix by -de.
     return kpt_fi.apply_kpt_vaihtelu(word)[:-2] + 'de'
 
+# Generate the genetiivi of -i words as if they ended in -e
+# (e.g. suuri -> suure).
+def get_gen_st_i_e(word):
+    return get_gen_st_1(word[:-1] + 'e')
+
+# Generate partitiivi form for sanatyyppi 1 words. suffix_vowel
+# is 'a' or 'ä', according to vowel harmony.
+def get_part_st_1(word, suffix_vowel):
+    if (not base_fi.is_vowel(word[-1]) or
+          len(word) > 1 and base_fi.is_vowel(word[-2]) and
+          not (word[-2] in base_fi.NEUTRAL_VOWELS and word[-1] in ['a', 'ä'])):
+        return word + 't' + suffix_vowel
+    else:
+        return word + suffix_vowel
+
+# Generate partitiivi form for e-sanatyyppi words.
+def get_part_st_e(word, suffix_vowel):
+    return word + 'tt' + suffix_vowel
+
+# Generate partitiivi form for nen-sanatyyppi words.
+def get_part_st_nen(word, suffix_vowel):
+    return word[:-3] + 'st' + suffix_vowel
+
+# Generate partitiivi form for si-sanatyyppi words.
+def get_part_st_si(word, suffix_vowel):
+    return word[:-2] + 'tt' + suffix_vowel
+
+# Generate the partitiivi forms of -i words: keeping the i,
+# dropping it and replacing it with e.
+def get_part_st_i(word, suffix_vowel):
+    return word + suffix_vowel
+
+def get_part_st_i_t(word, suffix_vowel):
+    return word[:-1] + 't' + suffix_vowel
+
+def get_part_st_i_e(word, suffix_vowel):
+    return word[:-1] + 'e' + suffix_vowel
+
+# A sanatyyppi: the functions generating the genetiivi vartalo
+# and the partitiivi candidates, in order of preference.
+Sanatyyppi = collections.namedtuple('Sanatyyppi',
+                                    ['name', 'genetiivi', 'partitiivi'])
+
+# The sanatyypit by the suffix of the perusmuoto that identifies
+# them. A word is of the sanatyyppi with the longest suffix it ends
+# in, and of sanatyyppi 1 (the empty suffix) if there is none.
+# -i words are ambiguous, so they get all candidates.
+# TODO(aeckleder): Not all sanatyypit are implemented.
+SANATYYPIT = {
+    '': Sanatyyppi('1', [get_gen_st_1], [get_part_st_1]),
+    'e': Sanatyyppi('e', [get_gen_st_e], [get_part_st_e]),
+    'nen': Sanatyyppi('nen', [get_gen_st_nen], [get_part_st_nen]),
+    'si': Sanatyyppi('si', [get_gen_st_si], [get_part_st_si]),
+    'i': Sanatyyppi('i', [get_gen_st_1, get_gen_st_i_e],
+                    [get_part_st_i, get_part_st_i_t, get_part_st_i_e]),
+}
+
+# Compile the sanatyypit into a trie of their reversed suffixes.
+# Every node is a dict from the next character (going backwards
+# from the end of the word) to the next node; the sanatyyppi of
+# a suffix ending at a node is stored under None.
+def compile_suffix_trie(sanatyypit):
+    root = {}
+    for suffix, sanatyyppi in sanatyypit.items():
+        node = root
+        for c in reversed(suffix):
+            node = node.setdefault(c, {})
+        node[None] = sanatyyppi
+    return root
+
+SUFFIX_TRIE = compile_suffix_trie(SANATYYPIT)
+
+# Find the sanatyyppi of word by its longest suffix in the trie.
+# This only looks at as many characters as the longest suffix has,
+# however many sanatyypit there are.
+def get_sanatyyppi(word):
+    node = SUFFIX_TRIE
+    sanatyyppi = node[None]
+    for c in reversed(word):
+        node = node.get(c)
+        if node is None:
+            break
+        sanatyyppi = node.get(None, sanatyyppi)
+    return sanatyyppi
+
 # Generate genetiivi vartalo candidates for the specified word.
 # This will apply kpt vaihtelu as appropriate and perform any
 # other applicable suffix transformation according to the
-# sanatyyppi of the word.
+# sanatyyppi of the word, which is looked up unless given.
 # ** Note that this returns a *list of candidates* whenever the
 #    sanatyyppi is ambiguous. This is currently the case for -i
 #    suffixes. The reason is that we're using these candidates
 #    to build an index. Not having a valid form in the index is
 #    strictly worse than having an invalid form in it. **
-def get_genetiivivartalo(word):
-    # Special casing for the different sanatyyppit.
-    # TODO(aeckleder): Not all sanatyyppit are implemented.
-    if len(word) and word[-1] == 'e':
-        return [get_gen_st_e(word)]
-    
-    if len(word) > 2 and word[-3:] == 'nen':
-        return [get_gen_st_nen(word)]
-    
-    if len(word) > 1 and word[-2:] == 'si':
-        return [get_gen_st_si(word)]
-    
-    if len(word) and word[-1] == 'i':
-        # Always produce both variants here, one with i (default)
-        # and one with e.
-        return [get_gen_st_1(word),
-                get_gen_st_1(word[:-1] + 'e')]
-    
-    # We default to sanatyyppi 1 if we don't find a better match.
-    # if word[-1] in base_fi.FRONT_VOWELS + base_fi.BACK_VOWELS:
-    return [get_gen_st_1(word)]
+def get_genetiivivartalo(word, sanatyyppi=None):
+    sanatyyppi = sanatyyppi or get_sanatyyppi(word)
+    return [f(word) for f in sanatyyppi.genetiivi]
 
 # Generate the partitiivi of the specified word.
 # ** Note that this returns a *list of candidates* whenever the
@@ -68,35 +137,16 @@ def get_genetiivivartalo(word):
 #    suffixes. The reason is that we're using these candidates
 #    to build an index. Not having a valid form in the index is
 #    strictly worse than having an invalid form in it. **
-def get_partitiivi(word):
+def get_partitiivi(word, sanatyyppi=None):
+    sanatyyppi = sanatyyppi or get_sanatyyppi(word)
     suffix_vowel = 'a' if base_fi.is_back_word(word) else 'ä'
-    # Special casing for different sanatyyppit.
-    # TODO(aeckleder): Not all sanatyyppit are implemented.
-    if word[-1] == 'e':
-        return [word + 'tt' + suffix_vowel]
-    if len(word) > 2 and word[-3:] == 'nen':
-        return [word[:-3] + 'st' + suffix_vowel]
-    if len(word) > 1 and word[-2:] == 'si':
-        return [word[:-2] + 'tt' + suffix_vowel]
-    if len(word) and word[-1] == 'i':
-        # Always produce three variants here, one with i (default),
-        # one by dropping the i and one by replacing i with e.
-        return [
-            word + suffix_vowel,
-            word[:-1] + 't' + suffix_vowel,
-            word[:-1] + 'e' + suffix_vowel]
-    
-    if (not base_fi.is_vowel(word[-1]) or
-          len(word) > 1 and base_fi.is_vowel(word[-2]) and
-          not (word[-2] in base_fi.NEUTRAL_VOWELS and word[-1] in ['a', 'ä'])):
-        return [word + 't' + suffix_vowel]
-    else:
-        return [word + suffix_vowel]
+    return [f(word, suffix_vowel) for f in sanatyyppi.partitiivi]
 
 # Produce declensions of the specified substantive
 def get_declensions(word):
     results = []
-    gen_vartalo_candidates = get_genetiivivartalo(word)
+    sanatyyppi = get_sanatyyppi(word)
+    gen_vartalo_candidates = get_genetiivivartalo(word, sanatyyppi)
     suffix_vowel = 'a' if base_fi.is_back_word(word) else 'ä'
     x = 0
     for gen_vartalo in gen_vartalo_candidates:
@@ -117,7 +167,7 @@ def get_declensions(word):
 
         x = x + 1
 
-    part_candidates = get_partitiivi(word)
+    part_candidates = [f(word, suffix_vowel) for f in sanatyyppi.partitiivi]
     x = 0
     for part in part_candidates:
         idx = '' if x == 0 else ' (alt {idx})'.format(idx=x)        
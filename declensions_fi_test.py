@@ -130,6 +130,31 @@ class TestDeclensionRules(unittest.TestCase):
         ]    
         for w in golden_declensions:
             self.assertGreaterEqual(set(dec_fi.get_declensions(w[0])), set(w[1]))
-            
+
+    def test_sanatyyppi(self):
+        golden_sanatyypit = [
+            ('museo', '1'),
+            ('jazz', '1'),
+            ('vene', 'e'),
+            ('valkoinen', 'nen'),
+            ('nen', 'nen'),
+            ('uusi', 'si'),
+            ('si', 'si'),
+            ('hotelli', 'i'),
+            ('i', 'i'),
+            ('', '1'),
+        ]
+        for word, name in golden_sanatyypit:
+            self.assertEqual(dec_fi.get_sanatyyppi(word).name, name, word)
+
+    def test_suffix_trie(self):
+        # The longest suffix wins, whatever the order of the table.
+        sanatyypit = {'': 'a', 'n': 'b', 'nen': 'c', 'en': 'd'}
+        trie = dec_fi.compile_suffix_trie(sanatyypit)
+        self.assertEqual(trie[None], 'a')
+        self.assertEqual(trie['n'][None], 'b')
+        self.assertEqual(trie['n']['e'][None], 'd')
+        self.assertEqual(trie['n']['e']['n'][None], 'c')
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,5 @@
 import re
+from functools import lru_cache
 
 # put the word at the front for the keys
 preps = r"\b(?:mit|an|furs?|ubers?|als|i(?:ns?|m)?|zu[rm]?|vo[nm]|aufs?|bis|durch|gegen|ohne|um|aus|auser|beim?|gegenuber|nach|seit|entlang|hinter|neben|unter|vorm?|zwischen|(?:an)?statt|trotz|wahrend|wegen|auserhalb|innerhalb|oberhalb|unterhalb|diesseits|jenseits|beiderseits)\b"
@@ -14,7 +15,8 @@ extras = r"(?:{[^\}]+}|\[[^\]]*\]|\([^\)]+\))"
 e = re.compile(extras)
 
 # remove articles
-articles = r"(?:^|\s)(?:d(?:e[rnms]|as|ie)|k?ein(?:e[rnms]?)?)(?:\s|$)"
+article = r"(?:d(?:e[rnms]|as|ie)|k?ein(?:e[rnms]?)?)"
+articles = r"(?:^|\s){article}(?:\s|$)".format(article=article)
 g = re.compile(articles)
 
 # Not a word
@@ -60,6 +62,93 @@ def getkey_old(key):
     return max(key.split(),
                key=lambda k: len(k))
 
+# getkey_old in a single scan over the words of the term.
+#
+# Removing the extras and then everything that isn't a word leaves
+# the words of the term separated by single spaces, so the later
+# passes of denoise can work on the list of words rather than the
+# string:
+#  g:  removes an article unless the article before it was removed
+#      (that match took the space in between)
+#  p:  removes objects, and prepositions with the word after them
+#  pr: removes the prepositions left, which again can't take the
+#      space taken by removing the word before them. After p there
+#      are wider gaps where it removed words: a gap of k removed
+#      groups is 2k+1 spaces.
+# Just like in denoise, a pass that would remove everything is
+# skipped. Terms without any words take the regular expressions.
+tokens = re.compile(r"{extras}|(\w+)".format(extras=extras))
+
+# Whether a word is an article, object or preposition
+ARTICLE, OBJECT, PREPOSITION = 1, 2, 4
+isarticle = re.compile(article).fullmatch
+isobject = re.compile(objs).fullmatch
+isprep = re.compile(preps).fullmatch
+
+@lru_cache(maxsize=100000)
+def kind(word):
+    return ((ARTICLE if isarticle(word) else 0) |
+            (OBJECT if isobject(word) else 0) |
+            (PREPOSITION if isprep(word) else 0))
+
+@lru_cache(maxsize=100000)
+def getkey_denoised(key):
+    words = [w for w in tokens.findall(key) if w]
+    if not words: return getkey_old(key)
+
+    # g: articles
+    kept = []
+    taken = False
+    for w in words:
+        if kind(w) & ARTICLE and not taken:
+            taken = True
+        else:
+            kept.append(w)
+            taken = False
+
+    # p: objects and prepositions with their word, recording
+    # the spaces before every word that is left
+    if not kept:
+        kept = words
+        gaps = [1] * len(kept)
+    else:
+        words = kept
+        kept = []
+        gaps = []
+        gap = 0
+        i = 0
+        while i < len(words):
+            k = kind(words[i])
+            if k & OBJECT: removed = 1
+            elif k & PREPOSITION and i+1 < len(words): removed = 2
+            else: removed = 0
+            if removed:
+                gap += 2
+                i += removed
+            else:
+                gaps.append(gap + 1 if kept else 0)
+                kept.append(words[i])
+                gap = 0
+                i += 1
+        if not kept:
+            kept = words
+            gaps = [1] * len(kept)
+
+    # pr: prepositions
+    words = kept
+    kept = []
+    taken = False
+    for i, w in enumerate(words):
+        free = i == 0 or gaps[i] > 1 or not taken
+        if kind(w) & PREPOSITION and free:
+            taken = True
+        else:
+            kept.append(w)
+            taken = False
+    if not kept: kept = words
+
+    return max(kept, key=lambda k: len(k))
+
 # Don't perform any transformations.
 def getdef(odef):
     return odef
@@ -0,0 +1,50 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Test cases for the dict.cc key extraction.
+
+import random
+import unittest
+import dictcc
+
+# Words and separators the random terms are made of, with all
+# kinds of articles, objects and prepositions next to each other
+WORDS = ['der', 'die', 'das', 'den', 'dem', 'des', 'ein', 'eine', 'einer',
+         'keinen', 'Der', 'mit', 'an', 'fur', 'furs', 'uber', 'als', 'i',
+         'in', 'ins', 'im', 'zu', 'zur', 'vom', 'auf', 'aus', 'auser', 'bei',
+         'beim', 'gegenuber', 'statt', 'anstatt', 'unter', 'vorm', 'Mit',
+         'selbst', 'sich', 'etwas', 'jeder', 'etw', 'jd', 'jdn', 'jdm',
+         'Tisch', 'geben', 'Haus', 'Ärger', 'x', 'ab', 'dies']
+SEPARATORS = [' ', ' ', ' ', '  ', '\t', '. ', ', ', '; ', '-', '/', ' (',
+              ') ', '{', '}', '[', ']', '?', "'", ' (etw.) ', ' {m} ',
+              ' [ugs.] ']
+
+class TestGetkey(unittest.TestCase):
+
+    def test_getkey_denoised(self):
+        golden_keys = [
+            ('der Tisch {m}', 'Tisch'),
+            ('etw. an jdn. geben [ugs.]', 'geben'),
+            ('sich um etw. kümmern', 'kümmern'),
+            ('eine Frage stellen', 'stellen'),
+            ('der die das', 'die'),
+            ('an an an x', 'an'),
+            ('der', 'der'),
+            ('{m}', '{m}'),
+        ]
+        for term, key in golden_keys:
+            self.assertEqual(dictcc.getkey_old(term), key)
+            self.assertEqual(dictcc.getkey_denoised(term), key)
+
+    # getkey_denoised gives the same keys as getkey_old
+    def test_golden(self):
+        rnd = random.Random(0)
+        for _ in range(50000):
+            term = ''.join(rnd.choice(WORDS) + rnd.choice(SEPARATORS)
+                           for _ in range(rnd.randint(1, 6)))
+            if rnd.random() < 0.5: term = term.strip()
+            self.assertEqual(dictcc.getkey_denoised(term),
+                             dictcc.getkey_old(term), term)
+
+if __name__ == '__main__':
+    unittest.main()
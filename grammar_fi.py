@@ -3,9 +3,26 @@
 # Module containing Finnish grammar rules to generate
 # inflections from basic forms (verbs in infinitive etc.).
 
+import hashlib
+
 import base_structures_fi as base_fi
 import conjugations_fi
 import declensions_fi
+import kpt_fi
+
+# Sources of the rules that determine the result of getinflections.
+RULE_SOURCES = [base_fi.__file__, kpt_fi.__file__, conjugations_fi.__file__,
+                declensions_fi.__file__, __file__]
+
+# Version of the inflection rules: a hash of the sources of this
+# and all rule modules, which changes whenever any rule does.
+# Used to invalidate inflections stored across builds.
+def rules_version():
+    h = hashlib.sha1()
+    for fname in RULE_SOURCES:
+        with open(fname, 'rb') as fr:
+            h.update(fr.read())
+    return h.hexdigest()
 
 # Trivially, ko/kö can be appended to almost every conceivable
 # word, so calling this will extend inflections by the appropriate ko/kö
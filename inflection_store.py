@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# Persistent store of inflections across builds.
+#
+# Inflecting the whole lexicon is the bulk of the work of a build,
+# and it gives the same result every time unless the grammar rules
+# change. The store keeps the inflections of every (word, word type)
+# in an sqlite database in a cache directory, keyed by the version
+# of the rules (grammar_fi.rules_version), so that changing a rule
+# automatically invalidates everything stored before.
+
+import json
+import multiprocessing.util
+import os
+import sqlite3
+
+import grammar_fi
+
+# Name of the database in the cache directory
+DATABASE = 'inflections.sqlite'
+
+# Number of new inflections buffered before they are written
+FLUSH_SIZE = 1000
+
+class InflectionStore:
+    def __init__(self, cachedir, version=None):
+        self.cachedir = cachedir
+        self.version = version or grammar_fi.rules_version()
+        self.db = None
+        self.pending = []
+
+    # Connect on first use, so that every process using the
+    # store (see __getstate__) has its own connection. The writer
+    # thread of a pipeline may use it too, but never at the same
+    # time as another thread.
+    def connect(self):
+        if self.db is None:
+            os.makedirs(self.cachedir, exist_ok=True)
+            self.db = sqlite3.connect(os.path.join(self.cachedir, DATABASE),
+                                      timeout=60, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS inflections ('
+                            'version TEXT, word TEXT, word_type TEXT, '
+                            'forms TEXT, '
+                            'PRIMARY KEY (version, word, word_type))')
+        return self.db
+
+    # The stored inflections of word, which is of word_type, as a
+    # list of (form, inflection) pairs, or None if there are none.
+    def get(self, word, word_type):
+        row = self.connect().execute(
+            'SELECT forms FROM inflections '
+            'WHERE version = ? AND word = ? AND word_type = ?',
+            (self.version, word, word_type)).fetchone()
+        if row is None: return None
+        return [tuple(i) for i in json.loads(row[0])]
+
+    def put(self, word, word_type, inflections):
+        self.pending.append((self.version, word, word_type,
+                             json.dumps(inflections, ensure_ascii=False)))
+        if len(self.pending) >= FLUSH_SIZE:
+            self.flush()
+
+    # Write all buffered inflections
+    def flush(self):
+        if not self.pending: return
+        with self.connect() as db:
+            db.executemany('INSERT OR REPLACE INTO inflections '
+                           'VALUES (?, ?, ?, ?)', self.pending)
+        self.pending = []
+
+    # Delete the inflections of any other version of the rules
+    def prune(self):
+        with self.connect() as db:
+            db.execute('DELETE FROM inflections WHERE version != ?',
+                       (self.version,))
+
+    def close(self):
+        self.flush()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    # A store is never sent to a worker process along with its
+    # Builder, nor its connection and buffered inflections;
+    # instead every process has its own, see processstore.
+    def __reduce__(self):
+        return processstore, (self.cachedir, self.version)
+
+# The InflectionStore of this process for cachedir and version.
+# Every task handed to a worker process unpickles its Builder
+# again, this keeps the store (and its connection) of the worker
+# across tasks. The store is closed when the process exits.
+PROCESS_STORES = {}
+def processstore(cachedir, version):
+    key = (cachedir, version)
+    if key not in PROCESS_STORES:
+        store = PROCESS_STORES[key] = InflectionStore(cachedir, version)
+        multiprocessing.util.Finalize(store, store.close, exitpriority=10)
+    return PROCESS_STORES[key]
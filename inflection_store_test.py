@@ -0,0 +1,62 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Test cases for the persistent inflection store.
+
+import pickle
+import tempfile
+import unittest
+import grammar_fi
+from inflection_store import InflectionStore
+
+class TestInflectionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def store(self, version='1'):
+        store = InflectionStore(self.tmpdir.name, version)
+        self.addCleanup(store.close)
+        return store
+
+    def test_roundtrip(self):
+        inflections = grammar_fi.getinflections('antaa', 'verb')
+        store = self.store()
+        self.assertIsNone(store.get('antaa', 'verb'))
+        store.put('antaa', 'verb', inflections)
+        store.close()
+        self.assertEqual(self.store().get('antaa', 'verb'), inflections)
+        self.assertIsNone(self.store().get('antaa', 'noun'))
+
+    def test_version(self):
+        store = self.store('1')
+        store.put('talo', 'noun', [('Genetiivi', 'talon')])
+        store.close()
+        self.assertIsNone(self.store('2').get('talo', 'noun'))
+        self.store('2').prune()
+        self.assertIsNone(self.store('1').get('talo', 'noun'))
+
+    def test_pickle(self):
+        store = self.store()
+        store.put('talo', 'noun', [('Genetiivi', 'talon')])
+        copy = pickle.loads(pickle.dumps(store))
+        self.addCleanup(copy.close)
+        self.assertEqual(copy.pending, [])
+        store.flush()
+        self.assertEqual(copy.get('talo', 'noun'), [('Genetiivi', 'talon')])
+        # Every copy in a process is the same store, with one connection
+        again = pickle.loads(pickle.dumps(store))
+        self.assertIs(again, copy)
+        self.assertIs(again.connect(), copy.connect())
+        other = pickle.loads(pickle.dumps(self.store('2')))
+        self.addCleanup(other.close)
+        self.assertIsNot(other, copy)
+
+    def test_rules_version(self):
+        self.assertEqual(grammar_fi.rules_version(), grammar_fi.rules_version())
+        self.assertEqual(InflectionStore(self.tmpdir.name).version,
+                         grammar_fi.rules_version())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,101 +2,107 @@
 #
 # Module containing kpt transformations for Finnish grammar.
 
+import re
+
 import base_structures_fi as base_fi
 
-# Apply kpt-vaihtelu to the specified word. This essentially
-# converts vahva into heikko and is lossy.
-def apply_kpt_vaihtelu(word):
-    syllables = base_fi.split_syllables(word)
-    if len(syllables) < 2:
-        # The first syllable is never subject to (inverse) kpt vaihtelu.
-        return word
-    # We generally modify only the first character of the last syllable
-    # (always a consonant), but we are also interested in the last character
-    # of the previous syllable.
-    last_syllable = syllables[-1]
-    prev_syllable = syllables[-2] if len(syllables) > 1 else None
+# The kpt rules as tables. We only ever modify the first character of
+# the last syllable (always a consonant), depending on the last
+# character of the previous syllable. For each such first character,
+# the table holds the replacements for particular previous characters
+# and the replacement for any other one. An empty replacement deletes
+# the character, characters not in the table are left alone.
 
-    # First character of a kpt tuple or None.
-    first_kpt = prev_syllable[-1] if prev_syllable else None
-    # This is the one we might be modifying, it always exists initially, but
-    # might be set to None for a deletion.
-    second_kpt = last_syllable[0]
+# kpt-vaihtelu, converting vahva into heikko.
+KPT_VAIHTELU = {
+    'k': ({'n': 'g',      # 'nk' -> 'ng'
+           's': 'k',      # 'sk' and 'tk' keep the 'k'
+           't': 'k'},
+          ''),            # 'k' -> '' and 'kk' -> 'k'
+    'p': ({'m': 'm',      # 'mp' -> 'mm'
+           'p': ''},      # 'pp' -> 'p'
+          'v'),           # 'p' -> 'v'
+    't': ({'n': 'n',      # 'nt' -> 'nn'
+           'l': 'l',      # 'lt' -> 'll'
+           'r': 'r',      # 'rt' -> 'rr'
+           't': '',       # 'tt' -> 't'
+           's': 't'},     # 'st' keeps the 't'
+          'd'),           # 't' -> 'd'
+}
 
-    if second_kpt == 'k':
-        if first_kpt == 'n':    # 'nk' -> 'ng' case
-            second_kpt = 'g'
-        elif first_kpt != 's' and first_kpt != 't': # 'k' -> '' and 'kk' -> 'k' cases
-            second_kpt = None
-        # If preceeded by 's' or 'k', just keep the 'k'.
-    elif second_kpt == 'p':
-        if first_kpt == 'm':   # 'mp' -> 'mm' case
-            second_kpt = 'm'
-        elif first_kpt == 'p': # 'pp' -> 'p' case
-            second_kpt = None
-        else:
-            second_kpt = 'v'   # 'p' -> 'v'
-    elif second_kpt == 't':
-        if first_kpt == 'n':   # 'nt' -> 'nn'
-            second_kpt = 'n'
-        elif first_kpt == 'l':  # 'lt' -> 'll'
-            second_kpt = 'l'
-        elif first_kpt == 'r':  # 'rt' -> 'rr'
-            second_kpt = 'r'
-        elif first_kpt == 't':  # 'tt' -> 't'
-            second_kpt = None
-        elif first_kpt != 's':
-            second_kpt = 'd'
-        # If preceeded by 's', just keep the 't'.
+# Inverse kpt-vaihtelu, converting heikko into vahva. We either
+# replace the character or insert one (k->kk, p->pp, t->tt).
+# TODO: _->'k' is unsupported, e.g. maata -> makaan.
+INVERSE_KPT_VAIHTELU = {
+    # 'sk' and 'tk' make it very unlikely that the strong form is 'skk' / 'tkk'.
+    'k': ({'s': 'k', 't': 'k'}, 'kk'),
+    'p': ({}, 'pp'),
+    # 'st' makes it very unlikely that the strong form is 'stt'.
+    't': ({'s': 't'}, 'tt'),
+    'v': ({}, 'p'),
+    'd': ({'s': 'd', 't': 'd'}, 't'),
+    'g': ({'n': 'k'}, 'g'),    # 'ng' -> 'nk'
+    'n': ({'n': 't'}, 'n'),    # 'nn' -> 'nt'
+    'm': ({'m': 'p'}, 'm'),    # 'mm' -> 'mp'
+    'l': ({'l': 't'}, 'l'),    # 'll' -> 'lt'
+    'r': ({'r': 't'}, 'r'),    # 'rr' -> 'rt'
+}
 
-    last_syllable = last_syllable[1:]
-    if second_kpt:
-        last_syllable = second_kpt + last_syllable
-    return "".join(syllables[:-1] + [last_syllable])
+# The last syllable of a word as split by base_fi.split_syllables,
+# found without splitting all of the word: after a vowel, either
+# all but the first of two or more trailing consonants, or the
+# consonants after the first of two or more (or else all of them)
+# before the last vowels and at most one trailing consonant.
+# Words of a single syllable don't match.
+LAST_SYLLABLE = re.compile(r'{v}(?:{c}({c}+)|{c}?({c}+{v}+{c}?))\Z'.format(
+    v=base_fi.VOWEL_CLASS, c=base_fi.CONSONANT_CLASS))
 
-# Apply inverse kpt-vaihtelu to the specified word. This essentially
-# converts heikko into vahva.
-def apply_inverse_kpt_vaihtelu(word):
-    syllables = base_fi.split_syllables(word)
-    if len(syllables) < 2:
+# Index of the first character of the last syllable of word,
+# or None if it has only one.
+def last_syllable_start(word):
+    m = LAST_SYLLABLE.search(word)
+    if m is None:
+        return None
+    return max(m.start(1), m.start(2))
+
+# Apply the kpt rules in table to word.
+def apply_kpt_table(word, table):
+    boundary = last_syllable_start(word)
+    if boundary is None:
         # The first syllable is never subject to (inverse) kpt vaihtelu.
         return word
-    # We generally modify only the last syllable: We either modify its first letter
-    # or insert a letter (k->kk, p->pp, t->tt, _->k). We are also interested in the
-    # last character of the previous syllable.
-    last_syllable = syllables[-1]
-    prev_syllable = syllables[-2] if len(syllables) > 1 else None
+    rule = table.get(word[boundary])
+    if rule is None:
+        return word
+    replacements, default = rule
+    return (word[:boundary] + replacements.get(word[boundary - 1], default) +
+            word[boundary + 1:])
 
-    # First character of a kpt tuple or None.
-    first_kpt = prev_syllable[-1] if prev_syllable else None
-    # This is the one we might be modifying. Any insertions happen directly into
-    # last_syllable.
-    second_kpt = last_syllable[0]
+# Apply kpt-vaihtelu to the specified word. This essentially
+# converts vahva into heikko and is lossy.
+def apply_kpt_vaihtelu(word):
+    return apply_kpt_table(word, KPT_VAIHTELU)
 
-    # TODO: _->'k' is unsupported, e.g. maata -> makaan.
-    # 'sk' and 'tk' make it very unlikely that the strong form is 'skk' / 'tkk'.
-    if second_kpt == 'k' and first_kpt not in ['s', 't']: 
-        last_syllable = 'k' + last_syllable # 'k' -> 'kk'
-    elif second_kpt == 'p':
-        last_syllable = 'p' + last_syllable # 'p' -> 'pp'
-    # 'st' makes it very unlikely that the strong form is 'stt'.
-    elif second_kpt == 't' and first_kpt != 's':
-        last_syllable = 't' + last_syllable # 't' -> 'tt'
-    elif second_kpt == 'v':
-        second_kpt = 'p' # 'c' -> 'p'
-    elif second_kpt == 'd' and first_kpt not in ['s', 't']:
-        second_kpt = 't' # 'd' -> 't'
-    elif second_kpt == 'g' and first_kpt == 'n':
-        second_kpt = 'k' # 'ng' -> 'nk'
-    elif second_kpt == 'n' and first_kpt == 'n':
-        second_kpt = 't' # 'nn' -> 'nt'
-    elif second_kpt == 'm' and first_kpt == 'm':
-        second_kpt = 'p' # 'mm' -> 'mp'
-    elif second_kpt == 'l' and first_kpt == 'l':
-        second_kpt = 't' # 'll' -> 'lt'
-    elif second_kpt == 'r' and first_kpt == 'r':
-        second_kpt = 't' # 'rr' -> 'rt'
+# Apply inverse kpt-vaihtelu to the specified word. This essentially
+# converts heikko into vahva.
+def apply_inverse_kpt_vaihtelu(word):
+    return apply_kpt_table(word, INVERSE_KPT_VAIHTELU)
+
+# Apply the kpt rules in table to every word in words, e.g. all
+# stems of a lexicon. Words that appear more than once are only
+# graded once. Returns the list of graded words.
+def apply_kpt_table_batch(words, table):
+    graded = {}
+    results = []
+    for word in words:
+        g = graded.get(word)
+        if g is None:
+            g = graded[word] = apply_kpt_table(word, table)
+        results.append(g)
+    return results
 
-    last_syllable = second_kpt + last_syllable[1:]
-    return "".join(syllables[:-1] + [last_syllable])
+def apply_kpt_vaihtelu_batch(words):
+    return apply_kpt_table_batch(words, KPT_VAIHTELU)
 
+def apply_inverse_kpt_vaihtelu_batch(words):
+    return apply_kpt_table_batch(words, INVERSE_KPT_VAIHTELU)
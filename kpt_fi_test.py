@@ -29,6 +29,43 @@ class TestKPTRules(unittest.TestCase):
         for p in golden_kpt_pairs:
             self.assertGreaterEqual(set(kpt_fi.apply_kpt_vaihtelu(p[0])),
                                     set(p[1]))
-            
+
+    def test_inverse_kpt(self):
+        golden_inverse_kpt_pairs = [
+            # Pairs of heikko and vahva
+            ('nuku', 'nukku'),
+            ('anna', 'anta'),
+            ('tiedä', 'tietä'),
+            ('ymmärrä', 'ymmärtä'),
+            ('odota', 'odotta'),
+            ('ongi', 'onki'),
+            ('kirjoita', 'kirjoitta'),
+
+            # Words of a single syllable are left alone.
+            ('syö', 'syö'),
+            ('kon', 'kon'),
+        ]
+
+        for p in golden_inverse_kpt_pairs:
+            self.assertEqual(kpt_fi.apply_inverse_kpt_vaihtelu(p[0]), p[1])
+
+    def test_last_syllable_start(self):
+        words = ['nukku', 'anta', 'kirjoitta', 'strand', 'talon', 'kon',
+                 'syö', 'a', '', 'kaarna', 'ymmärtä', 'hauska']
+        for word in words:
+            syllables = kpt_fi.base_fi.split_syllables(word)
+            expected = (len(word) - len(syllables[-1])
+                        if len(syllables) >= 2 else None)
+            self.assertEqual(kpt_fi.last_syllable_start(word), expected, word)
+
+    def test_batch(self):
+        words = ['nukku', 'anta', 'nukku', 'etsi', 'anta', 'tietä']
+        self.assertEqual(kpt_fi.apply_kpt_vaihtelu_batch(words),
+                         [kpt_fi.apply_kpt_vaihtelu(w) for w in words])
+        heikko = kpt_fi.apply_kpt_vaihtelu_batch(words)
+        self.assertEqual(kpt_fi.apply_inverse_kpt_vaihtelu_batch(heikko),
+                         [kpt_fi.apply_inverse_kpt_vaihtelu(w) for w in heikko])
+        self.assertEqual(kpt_fi.apply_kpt_vaihtelu_batch([]), [])
+
 if __name__ == '__main__':
     unittest.main()
@@ -44,34 +44,94 @@ VERSION = "0.2"
 import sys
 import os
 import argparse
-from itertools import islice, count, groupby
-from contextlib import contextmanager
-from xml.sax.saxutils import escape
+import bisect
+import bz2
+import cProfile
+import gzip
+import io
+import lzma
+import hashlib
+import heapq
+import json
+import pickle
+import queue
+import string
+import tempfile
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, count, groupby, chain
+from operator import itemgetter
+from contextlib import contextmanager, nullcontext, redirect_stdout
 import importlib
 
 import grammar_fi
+from inflection_store import InflectionStore
 
 # Stop with the encoding -- it's broken anyhow
 # in the kindles and undefined.
-def normalizeLetter(ch):
-    try: ch = mapping[ch]
-    except KeyError: pass
-    return ch
+# Instead, mapping reduces some characters to something else.
+# It is compiled into a str.translate table once, so that
+# normalizing a term is a single pass in C.
+def normalizetable(mapping):
+    return str.maketrans({ch: repl for ch, repl in mapping.items()
+                          if len(ch) == 1})
 
-def normalizeUnicode(text):
-    """
-    Reduce some characters to something else
-    """
-    return ''.join(normalizeLetter(c) for c in text)
+# Translate table for xml.sax.saxutils.escape
+ESCAPE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+# Table normalizing by mapping and escaping the result in
+# the same pass
+def normalizeescapetable(mapping):
+    table = dict(ESCAPE)
+    for ch, repl in normalizetable(mapping).items():
+        table[ch] = repl.translate(ESCAPE)
+    return table
+
+# Lower case, strip and escape text, the same as
+# escape(text.lower().strip()). Escaping first doesn't change
+# the result, as neither lower() nor strip() produce or remove
+# any of &, < and >, so table can also normalize at the same time.
+def foldkey(text, table=ESCAPE):
+    return text.translate(table).lower().strip()
+
+# Number of inflections cached by default, see LRUCache
+DEFAULT_CACHE_SIZE = 100000
 
 # Args:
 #  --verbose
 #  --module: module to load and attempt to extract getdef, getkey & mapping
+#            and the batch hooks getkeys_batch & getdefs_batch
 #  --source: source language code (en by default)
 #  --target: target language code (en by default)
-#  file: the tab delimited file to read
+#  --sort-budget: maximum number of entries held in memory while
+#                 sorting, spilling sorted runs to temporary files
+#                 (everything is sorted in memory by default)
+#  --jobs: number of worker processes computing inflections and
+#          writing key files (1 by default)
+#  --incremental: only rewrite the key files whose entries changed
+#                 since the last incremental build
+#  --shard-bytes: start a new key file before it exceeds this many bytes
+#  --shard-iforms: start a new key file before it exceeds this many iforms
+#  --cache-size: number of inflections cached in memory (0 disables)
+#  --inflection-store: directory of a persistent store of inflections
+#  --pipeline: read the input and write the key files in threads of
+#              their own, connected by queues of this many items
+#              (0 runs everything in turn)
+#  --estimate-only: don't write anything, only print what the
+#                   key files would contain
+#  --stats-json: write timing statistics of the build to this file as JSON
+#  --profile: dump cProfile statistics of the build to this file
+#  --presorted: the files are sorted by key, merge them while
+#               writing instead of sorting all entries
+#  --strict-order: fail if the --presorted files aren't sorted,
+#                  instead of sorting them after all
+#  --name: basename of the output files
+#  file: the tab delimited files to read, may be gzip, bzip2 or xz
+#        compressed, - reads from stdin
 
-def parseargs():
+def parseargs(argv=None):
     if len(sys.argv) < 1:
         print("tab2opf (Stardict->MobiPocket)")
         print("------------------------------")
@@ -90,111 +150,647 @@ def parseargs():
                         help="Import module for mapping, getkey, getdef")
     parser.add_argument("-s", "--source", default="fi", help="Source language")
     parser.add_argument("-t", "--target", default="en", help="Target language")
-    parser.add_argument("file", help="tab file to input")    
-    return parser.parse_args()
+    parser.add_argument("--sort-budget", type=int, default=0, metavar="N",
+                        help="Keep at most N entries in memory, merging "
+                        "sorted runs from temporary files")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="Compute inflections and write key files "
+                        "in N worker processes")
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="Only rewrite key files whose entries changed")
+    parser.add_argument("--shard-bytes", type=int, default=0, metavar="N",
+                        help="Split key files at about N bytes instead of "
+                        "only every 10000 keys")
+    parser.add_argument("--shard-iforms", type=int, default=0, metavar="N",
+                        help="Split key files at N inflection forms instead "
+                        "of only every 10000 keys")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE,
+                        metavar="N", help="Cache the inflections of N words "
+                        "in every process (0 disables the cache)")
+    parser.add_argument("--inflection-store", metavar="DIR",
+                        help="Keep the inflections in a database in DIR "
+                        "to reuse them in later builds")
+    parser.add_argument("--pipeline", type=int, default=0, metavar="N",
+                        help="Read the input and write key files in "
+                        "threads, queueing up to N batches of lines and "
+                        "N key files")
+    parser.add_argument("--estimate-only", action="store_true",
+                        help="Only print the size of the output, "
+                        "without writing any files")
+    parser.add_argument("--stats-json", metavar="FILE",
+                        help="Write per phase timing statistics as JSON "
+                        "to FILE (- for stdout, which moves the progress "
+                        "messages to stderr)")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="Dump cProfile statistics to FILE")
+    parser.add_argument("--presorted", action="store_true",
+                        help="The files are already sorted by key, "
+                        "merge them instead of sorting")
+    parser.add_argument("--strict-order", action="store_true",
+                        help="Fail if the --presorted files aren't sorted "
+                        "instead of sorting them")
+    parser.add_argument("-n", "--name",
+                        help="Basename of the output files (by default "
+                        "the input file name without extensions)")
+    parser.add_argument("file", nargs="+", help="tab files to input, "
+                        "optionally compressed, - for stdin")
+    return parser.parse_args(argv)
+
+# The default getkey and getdef don't transform anything.
+# These are plain functions rather than lambdas, so that
+# a Builder can be handed to worker processes.
+def identity(x):
+    return x
+
+# Batch hook calling a scalar hook on every item, for modules
+# that only define getkey or getdef and not getkeys_batch or
+# getdefs_batch. Again a class so that it can be pickled.
+class ScalarBatch:
+    def __init__(self, hook):
+        self.hook = hook
+
+    def __call__(self, items):
+        return [self.hook(item) for item in items]
 
 def loadmember(mod, attr, dfault):
     if hasattr(mod, attr):
         print("Loading {} from {}".format(attr, mod.__name__))
-        globals()[attr] = getattr(mod, attr)
-    else: globals()[attr] = dfault
+        return getattr(mod, attr)
+    return dfault
 
-def importmod():
-    global MODULE
-    if MODULE is None: mod = None
+# Load the hooks of module. Besides getkey and getdef a module may
+# define getkeys_batch and getdefs_batch, which take a list of
+# terms or definitions and return a list of keys or definitions,
+# for modules that are faster at handling many lines at once.
+# Either falls back to calling the scalar hook on every item.
+#
+# Returns (getkey, getdef, mapping, getkeys_batch, getdefs_batch).
+def importmod(module):
+    if module is None: mod = None
     else:
-        mod = importlib.import_module(MODULE)
+        mod = importlib.import_module(module)
         print("Loading methods from: {}".format(mod.__file__))
 
-    loadmember(mod, 'getkey', lambda key: key)
-    loadmember(mod, 'getdef', lambda dfn: dfn)
-    loadmember(mod, 'mapping', {})
-
-args = parseargs()
-VERBOSE  = args.verbose
-FILENAME = args.file
-MODULE   = args.module
-INLANG   = args.source
-OUTLANG  = args.target
-importmod()
-
-# add a single [term, definition]
-# to defs[key]
-# r is a tab split line
-def readkey(r, defs):
-    try: term, defn =  r.split('\t',1)
-    except ValueError:
-        print("Bad line: '{}'".format(r))
-        raise
-
-    term = term.strip()
-    defn = getdef(defn)
-    defn = escape(defn.\
-        replace("\\n","<br/>\n").\
-        strip())
-
-    split_defn = defn.split('\t', 3)
-    word_type = split_defn[1] if len(split_defn) > 1 else 'unknown'
-
-    # key is the 'translated' key, nkey is the
-    # normalized original key.
-    nkey = normalizeUnicode(term)    
-    key = getkey(nkey)
-
-    # Both are escaped not to produce any undesired html.
-    key = escape(key.lower().strip())
-    nkey = escape(nkey.lower().strip())
-
-    if key == '':
-        raise Exception("Missing key {}".format(term))
-    if defn == '':
-        raise Exception("Missing definition {}".format(term))
-
-    if VERBOSE: print(key, ":", term)
-
-    # ndef is the value of the map. It's essentially an array
-    # with each index having a special meaning:
-    #  index 0: The original term
-    #  index 1: The definition
-    #  index 2: Whether the key matches the translated key.
-    #           This is primarily used as a sorting criteria.
-    #  index 3: Word type (noun, verb etc.)
-    #  index 4: A list of inflections based on key. These are
-    #           tuples of the form (form, inflection), e.g.
-    #           ("first person singluar", "menen").
-    ndef = [term, defn, key == nkey, word_type,
-            grammar_fi.getinflections(key, word_type)]
-    if key in defs: defs[key].append(ndef)
-    else:           defs[key] = [ndef]
+    getkey = loadmember(mod, 'getkey', identity)
+    getdef = loadmember(mod, 'getdef', identity)
+    return (getkey, getdef, loadmember(mod, 'mapping', {}),
+            loadmember(mod, 'getkeys_batch', ScalarBatch(getkey)),
+            loadmember(mod, 'getdefs_batch', ScalarBatch(getdef)))
+
+# Compressed input is recognized by its magic bytes
+COMPRESSION = [
+    (b'\x1f\x8b', gzip.open, '.gz'),
+    (b'BZh', bz2.open, '.bz2'),
+    (b'\xfd7zXZ\x00', lzma.open, '.xz'),
+]
+
+# Number of bytes needed to recognize any of the COMPRESSION formats
+MAGIC_BYTES = max(len(prefix) for prefix, _, _ in COMPRESSION)
+
+# Raw stream that reads prefix and then the rest of the
+# buffered stream it was taken from
+class PrefixedReader(io.RawIOBase):
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.prefix:
+            n = min(len(b), len(self.prefix))
+            b[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            return n
+        return self.stream.readinto1(b)
+
+# Open filename for reading as utf-8 text, where filename is
+# either a path or - for stdin. gzip, bzip2 and xz compressed
+# input is decompressed on the fly, so nothing has to be
+# unpacked to disk first.
+@contextmanager
+def openinput(filename):
+    raw = sys.stdin.buffer if filename == '-' else open(filename, 'rb')
+    try:
+        magic = raw.peek(MAGIC_BYTES)[:MAGIC_BYTES]
+        stream = raw
+        if len(magic) < MAGIC_BYTES:
+            # A pipe may not have all of it yet: read it (up to
+            # EOF) and put it back in front of the rest.
+            magic = raw.read(MAGIC_BYTES)
+            stream = io.BufferedReader(PrefixedReader(magic, raw))
+        for prefix, decompressor, _ in COMPRESSION:
+            if magic.startswith(prefix):
+                stream = decompressor(stream)
+                break
+        text = io.TextIOWrapper(stream, encoding='utf-8')
+        try: yield text
+        finally:
+            # Don't let the wrapper close stdin
+            text.detach()
+            if stream is not raw: stream.close()
+    finally:
+        if filename != '-': raw.close()
+
+# Output basename for filename: the file name without the
+# compression suffix and extension, e.g. dict for dict.tab.gz
+def defaultname(filename):
+    if filename == '-': return 'dictionary'
+    name = os.path.basename(filename)
+    for _, _, suffix in COMPRESSION:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return os.path.splitext(name)[0]
+
+# Everything a build needs to know. The attributes mirror
+# the command line arguments:
+#  filenames:   the tab delimited files to read, see openinput.
+#               A single file name may be given as a string.
+#  module:      module to load getkey, getdef & mapping from
+#               (None for none)
+#  source:      source language code
+#  target:      target language code
+#  verbose:     make verbose
+#  sort_budget: maximum number of entries held in memory while
+#               sorting (0 sorts everything in memory)
+#  jobs:        number of worker processes
+#  incremental: only rewrite key files whose entries changed
+#               since the last incremental build
+#  shard_bytes: maximum size in bytes of a key file (0 for no limit)
+#  shard_iforms: maximum number of iforms in a key file (0 for no limit)
+#  cache_size:  number of inflections cached by every process
+#               (0 disables the cache)
+#  inflection_store: cache directory of the persistent
+#               InflectionStore (None for none)
+#  pipeline:    depth of the queues between the threads reading the
+#               input, parsing it and writing the key files
+#               (0 for no threads). Only used without --jobs, which
+#               overlaps the stages in worker processes instead.
+#  estimate_only: go through the build without writing any files
+#               and print the size of the output, see printestimate
+#  stats_json:  file to write Stats.report() to as JSON
+#               (- for stdout, None for none)
+#  profile:     file to dump cProfile statistics to (None for none)
+#  presorted:   the files are sorted by key, see mergegroups
+#  strict_order: fail rather than sort if the presorted files
+#               aren't sorted, see sortedwrite
+#  name:        basename of the output files, see defaultname
+#               of the first file
+#  outdir:      directory the output files are written to
+class Config:
+    def __init__(self, filenames, module="dictcc", source="fi", target="en",
+                 verbose=False, sort_budget=0, jobs=1, incremental=False,
+                 shard_bytes=0, shard_iforms=0,
+                 cache_size=DEFAULT_CACHE_SIZE, inflection_store=None,
+                 pipeline=0, estimate_only=False, stats_json=None,
+                 profile=None, presorted=False,
+                 strict_order=False, name=None, outdir="."):
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        self.filenames = list(filenames)
+        self.module = module
+        self.source = source
+        self.target = target
+        self.verbose = verbose
+        self.sort_budget = sort_budget
+        self.jobs = jobs
+        self.incremental = incremental
+        self.shard_bytes = shard_bytes
+        self.shard_iforms = shard_iforms
+        self.cache_size = cache_size
+        self.inflection_store = inflection_store
+        self.pipeline = pipeline
+        self.estimate_only = estimate_only
+        self.stats_json = stats_json
+        self.profile = profile
+        self.presorted = presorted
+        self.strict_order = strict_order
+        if name is None:
+            name = defaultname(self.filenames[0])
+        self.name = name
+        self.outdir = outdir
+
+    # Build the configuration from the result of parseargs
+    @classmethod
+    def fromargs(cls, args):
+        return cls(args.file, module=args.module, source=args.source,
+                   target=args.target, verbose=args.verbose,
+                   sort_budget=args.sort_budget, jobs=args.jobs,
+                   incremental=args.incremental,
+                   shard_bytes=args.shard_bytes,
+                   shard_iforms=args.shard_iforms,
+                   cache_size=args.cache_size,
+                   inflection_store=args.inflection_store,
+                   pipeline=args.pipeline,
+                   estimate_only=args.estimate_only,
+                   stats_json=args.stats_json, profile=args.profile,
+                   presorted=args.presorted,
+                   strict_order=args.strict_order, name=args.name)
+
+# A parsed entry, the values of the key --> [Entry...] map.
+# Entries are created for every input line, so they carry
+# no per-instance dict, and the word types and inflection
+# form names, which repeat all the time, are interned.
+#  term:        The original term
+#  defn:        The definition
+#  exact:       Whether the key matches the translated key.
+#               This is primarily used as a sorting criteria.
+#  word_type:   Word type (noun, verb etc.)
+#  inflections: A tuple of inflections based on key. These are
+#               tuples of the form (form, inflection), e.g.
+#               ("first person singluar", "menen"), or None
+#               while they haven't been computed yet.
+class Entry:
+    __slots__ = ('term', 'defn', 'exact', 'word_type', 'inflections')
+
+    def __init__(self, term, defn, exact, word_type, inflections=None):
+        self.term = term
+        self.defn = defn
+        self.exact = exact
+        self.word_type = sys.intern(word_type)
+        self.inflections = inflections
+
+    # The fields the inflections are derived from
+    def content(self):
+        return [self.term, self.defn, self.exact, self.word_type]
+
+# Store inflections as a tuple with interned form names
+def packinflections(inflections):
+    return tuple((sys.intern(form), value) for form, value in inflections)
+
+# Wall and cpu time (including finished child processes) in seconds
+def clock():
+    t = os.times()
+    return (time.perf_counter(),
+            t.user + t.system + t.children_user + t.children_system)
+
+# Statistics of a build:
+#  phases: wall and cpu time spent in each phase (read, write, opf).
+#          Phases nest, and the time of a nested phase is not counted
+#          in the enclosing one.
+#  lines:  number of input lines parsed
+#  hooks:  calls of and time spent in getkey, getdef and
+#          getinflections, see Timed. getkey and getdef are
+#          called once per batch of lines.
+#  shards: size in bytes of every key file written
+#  cache:  hits and misses of the inflection cache
+#  store:  hits and misses of the persistent inflection store
+#  queues: number of items passed through, and the sum and maximum
+#          of the depth of every queue of the pipeline (--pipeline)
+#          when an item was taken. A queue that is mostly full
+#          waits for the stage after it, one that is mostly empty
+#          for the stage before.
+#  keyfiles: headwords, entries, iforms and size in bytes of
+#          every key file, see addkeyfile
+#  inflections: number of entries by word type and number of iforms
+#  largest: the LARGEST_KEYS largest keys as (bytes, key) pairs
+# Worker processes collect their own lines, hooks and shards, which
+# are merged into the Stats of the main process.
+# Phases are only entered by the main thread; every queue of the
+# pipeline is sampled by a single thread.
+class Stats:
+    def __init__(self):
+        self.phases = {}
+        self.stack = []
+        self.mark = None
+        self.clear()
+
+    # Reset everything collected by worker processes
+    def clear(self):
+        self.lines = 0
+        self.hooks = {}
+        self.shards = {}
+        self.cache = [0, 0]
+        self.store = [0, 0]
+        self.queues = {}
+        self.keyfiles = {}
+        self.inflections = {}
+        self.largest = []
+
+    # Charge the time since the last mark to the current phase
+    def charge(self):
+        now = clock()
+        if self.stack:
+            p = self.phases.setdefault(self.stack[-1], [0.0, 0.0])
+            p[0] += now[0] - self.mark[0]
+            p[1] += now[1] - self.mark[1]
+        self.mark = now
+
+    @contextmanager
+    def phase(self, name):
+        self.charge()
+        self.stack.append(name)
+        try: yield
+        finally:
+            self.charge()
+            self.stack.pop()
+
+    def addhook(self, name, seconds):
+        h = self.hooks.setdefault(name, [0, 0.0])
+        h[0] += 1
+        h[1] += seconds
+
+    # Account for the (key, defn) pairs in keys making up
+    # key file fname
+    def addkeyfile(self, fname, keys):
+        nbytes = KEYFILE_BYTES
+        entries = iforms = 0
+        for key, defn in keys:
+            b = keybytes(key, defn)
+            nbytes += b
+            entries += len(defn)
+            for entry in defn:
+                n = len(entry.inflections) if entry.inflections else 0
+                iforms += n
+                counts = self.inflections.setdefault(entry.word_type, {})
+                counts[n] = counts.get(n, 0) + 1
+            self.addlargest(b, key)
+        self.keyfiles[fname] = {'headwords': len(keys), 'entries': entries,
+                                'iforms': iforms, 'bytes': nbytes}
+
+    def addlargest(self, nbytes, key):
+        if len(self.largest) < LARGEST_KEYS:
+            heapq.heappush(self.largest, (nbytes, key))
+        elif (nbytes, key) > self.largest[0]:
+            heapq.heapreplace(self.largest, (nbytes, key))
+
+    # The totals of keyfiles, inflections and largest
+    def output(self):
+        files = self.keyfiles.values()
+        return {
+            'keyfiles': self.keyfiles,
+            'headwords': sum(f['headwords'] for f in files),
+            'entries': sum(f['entries'] for f in files),
+            'iforms': sum(f['iforms'] for f in files),
+            'bytes': sum(f['bytes'] for f in files),
+            'inflections': self.inflections,
+            'largest': [{'key': key, 'bytes': nbytes} for nbytes, key
+                        in sorted(self.largest, reverse=True)],
+        }
+
+    def sample(self, name, depth):
+        q = self.queues.setdefault(name, [0, 0, 0])
+        q[0] += 1
+        q[1] += depth
+        q[2] = max(q[2], depth)
+
+    def merge(self, other):
+        self.lines += other.lines
+        for name, (calls, seconds) in other.hooks.items():
+            h = self.hooks.setdefault(name, [0, 0.0])
+            h[0] += calls
+            h[1] += seconds
+        self.shards.update(other.shards)
+        self.cache[0] += other.cache[0]
+        self.cache[1] += other.cache[1]
+        self.store[0] += other.store[0]
+        self.store[1] += other.store[1]
+        for name, (items, total, deepest) in other.queues.items():
+            q = self.queues.setdefault(name, [0, 0, 0])
+            q[0] += items
+            q[1] += total
+            q[2] = max(q[2], deepest)
+        self.keyfiles.update(other.keyfiles)
+        for word_type, counts in other.inflections.items():
+            mine = self.inflections.setdefault(word_type, {})
+            for n, entries in counts.items():
+                mine[n] = mine.get(n, 0) + entries
+        for nbytes, key in other.largest:
+            self.addlargest(nbytes, key)
+
+    # The statistics as a JSON serializable dict
+    def report(self):
+        read = self.phases.get('read', [0.0, 0.0])[0]
+        return {
+            'phases': {name: {'wall': wall, 'cpu': cpu}
+                       for name, (wall, cpu) in self.phases.items()},
+            'total': {'wall': sum(p[0] for p in self.phases.values()),
+                      'cpu': sum(p[1] for p in self.phases.values())},
+            'lines': self.lines,
+            'lines_per_second': self.lines / read if read else None,
+            'hooks': {name: {'calls': calls, 'seconds': seconds}
+                      for name, (calls, seconds) in self.hooks.items()},
+            'shards': self.shards,
+            'inflection_cache': {'hits': self.cache[0],
+                                 'misses': self.cache[1]},
+            'inflection_store': {'hits': self.store[0],
+                                 'misses': self.store[1]},
+            'queues': {name: {'items': items,
+                              'mean_depth': total / items if items else 0,
+                              'max_depth': deepest}
+                       for name, (items, total, deepest)
+                       in self.queues.items()},
+            'output': self.output(),
+        }
+
+# Number of largest keys listed by Stats
+LARGEST_KEYS = 10
+
+# Wraps a hook (getkey, getdef, getinflections) to record the
+# time spent in it in stats. Unlike a closure, this can be
+# pickled along with a Builder.
+class Timed:
+    def __init__(self, name, func, stats):
+        self.name = name
+        self.func = func
+        self.stats = stats
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        try: return self.func(*args)
+        finally: self.stats.addhook(self.name, time.perf_counter() - start)
+
+# Bounded least recently used cache. Dictionaries repeat the
+# same headword a lot (dict.cc has a line per sense), so the
+# inflections of a (word, word type) are cached rather than
+# computed again for every entry.
+# A cache is never sent to a worker process along with its
+# Builder; instead every process has its own, see processcache.
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    # The cached value of key, None if there is none
+    def get(self, key):
+        try: value = self.entries[key]
+        except KeyError: return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __reduce__(self):
+        return processcache, (self.maxsize,)
+
+# The LRUCache of this process with maxsize entries. Every task
+# handed to a worker process unpickles its Builder again, this
+# keeps the cache of the worker across tasks.
+PROCESS_CACHES = {}
+def processcache(maxsize):
+    if maxsize not in PROCESS_CACHES:
+        PROCESS_CACHES[maxsize] = LRUCache(maxsize)
+    return PROCESS_CACHES[maxsize]
+
+# Submit fn(*args) for each tuple of args in tasks to pool,
+# yielding the results in order. Only depth tasks are in
+# flight at any time, so that the input isn't read into
+# memory ahead of the consumer.
+def boundedmap(pool, fn, tasks, depth):
+    pending = deque()
+    for args in tasks:
+        pending.append(pool.submit(fn, *args))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+# Iterate over items in a thread of its own, which runs at most
+# depth items ahead of the caller. This is the first stage of the
+# pipeline of --pipeline: the input is read and decompressed while
+# the lines read before are parsed and inflected.
+# The depth of the queue is sampled into stats under name.
+def prefetch(items, depth, name, stats):
+    q = queue.Queue(depth)
+    stop = threading.Event()
+    def run():
+        try:
+            for item in items:
+                if stop.is_set(): return
+                q.put((True, item))
+            q.put((False, None))
+        except BaseException as e:
+            q.put((False, e))
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            depth = q.qsize()
+            more, item = q.get()
+            if not more:
+                if item is not None: raise item
+                return
+            stats.sample(name, depth)
+            yield item
+    finally:
+        # Unblock the thread if the caller stopped early
+        stop.set()
+        while thread.is_alive():
+            try: q.get(timeout=0.1)
+            except queue.Empty: pass
+
+# The last stage of the pipeline of --pipeline: calls fn(item) in
+# a thread of its own for the items put into it, while the caller
+# goes on with the next ones. At most depth items wait in the
+# queue, whose depth is sampled into stats under name.
+# An exception of fn is raised again by the next put and when the
+# with block is left; the remaining items are skipped.
+class Consumer:
+    DONE = object()
+
+    def __init__(self, fn, depth, name, stats):
+        self.fn = fn
+        self.name = name
+        self.stats = stats
+        self.queue = queue.Queue(depth)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name=name,
+                                       daemon=True)
+
+    def run(self):
+        while True:
+            depth = self.queue.qsize()
+            item = self.queue.get()
+            if item is self.DONE: return
+            self.stats.sample(self.name, depth)
+            if self.error is None:
+                try: self.fn(item)
+                except BaseException as e: self.error = e
+
+    def put(self, item):
+        if self.error is not None: raise self.error
+        self.queue.put(item)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.queue.put(self.DONE)
+        self.thread.join()
+        if self.error is not None and exc_type is None: raise self.error
+
+# Raised when an input file given as sorted isn't
+class InputOrderError(ValueError):
+    pass
+
+# Pass the (key, entry) records of filename through, raising
+# InputOrderError as soon as a key is smaller than the one before
+def checkorder(records, filename):
+    last = None
+    for key, entry in records:
+        if last is not None and key < last:
+            raise InputOrderError(
+                "{}: key '{}' of '{}' comes after '{}', the input "
+                "isn't sorted by key".format(filename, key, entry.term, last))
+        last = key
+        yield key, entry
 
 # Skip empty lines and lines that only have a comment
 def inclline(s):
     s = s.lstrip()
     return len(s) != 0 and s[0] != '#'
 
-# Iterate over FILENAME, reading lines of
-# term {tab} definition
-# skips empty lines and commented out lines
-#
-def readkeys():
-    if VERBOSE: print("Reading {}".format(FILENAME))
-    with open(FILENAME,'r', encoding='utf-8') as fr:
-        defns = {}
-        for r in filter(inclline, fr):
-            readkey(r, defns)
-        return defns
+# Number of lines handed to a worker process at once
+BATCH_SIZE = 1000
 
-# Write to key file {name}{n}.html
-# put the body inside the context manager
+# Split the iterable it into lists of at most n items
+def batches(it, n):
+    it = iter(it)
+    while True:
+        batch = list(islice(it, n))
+        if not batch: return
+        yield batch
+
+# Maximum number of run files merged at once by externalsort
+MERGE_RUNS = 64
+
+# Write the sorted (key, seq, entry) records to a temporary
+# run file in tmpdir. Returns the file name.
+def writerun(records, tmpdir):
+    fd, fname = tempfile.mkstemp(suffix='.run', dir=tmpdir)
+    with os.fdopen(fd, 'wb') as to:
+        for r in records:
+            pickle.dump(r, to, pickle.HIGHEST_PROTOCOL)
+    return fname
+
+# Read back the records of a run written by writerun.
+def readrun(fname):
+    with open(fname, 'rb') as fr:
+        while True:
+            try: yield pickle.load(fr)
+            except EOFError: return
+
+# Order definitions by keys, then by whether the key
+# matches the original term, then by length of term
+# then alphabetically
+def keyf(entry):
+    term = entry.term
+    if entry.exact: l = 0
+    else: l = len(term)
+    return l, term
+
+# Start and end of every key file.
 # The onclick here gives a kindlegen warning
 # but appears to be necessary to actually
 # have a lookup dictionary
-@contextmanager
-def writekeyfile(name, i):
-    fname = "{}{}.html".format(name, i)
-    if VERBOSE: print("Key file: {}".format(fname))
-    with open(fname, 'w') as to:
-        to.write("""<?xml version="1.0" encoding="utf-8"?>
+KEYFILE_HEAD = """<?xml version="1.0" encoding="utf-8"?>
 <html xmlns:idx="www.mobipocket.com" xmlns:mbp="www.mobipocket.com" xmlns:xlink="http://www.w3.org/1999/xlink">
   <body>
     <mbp:pagebreak/>
@@ -205,93 +801,557 @@ def writekeyfile(name, i):
         </div>
       </mbp:slave-frame>
       <mbp:pagebreak/>
-""")
-        try: yield to
-        finally:
-            to.write("""
+"""
+KEYFILE_TAIL = """
     </mbp:frameset>
   </body>
 </html>
-        """)
+        """
 
-# Order definitions by keys, then by whether the key
-# matches the original term, then by length of term
-# then alphabetically
-def keyf(defn):
-    term = defn[0]
-    if defn[2]: l = 0
-    else: l = len(term)
-    return l, term
-
-# Write into to the key, definition pairs
-# key -> [[term, defn, key==term]]
-def writekey(to, key, defn):
-    terms = iter(sorted(defn, key=keyf))
-    for term, g in groupby(terms, key=lambda d: d[0]):
-        defs = list(g)
-        to.write(
-"""
+# Templates for the markup of a key. The entry template is
+# repeated for every distinct term of a key, with an infl block
+# for each of its entries with inflections, holding an iform per
+# inflection.
+ENTRY_TEMPLATE = """
         <idx:entry name="word" scriptable="yes" spell="yes">
           <h2>
             <idx:orth value="{key}">{term}
-""".format(key=key, term=term))
-        # Now write any inflections we know of
-        for _, _, _, word_type, inflections in defs:
-            if inflections:
-                to.write(
-"""                
+"""
+INFL_TEMPLATE = """                
                 <idx:infl inflgrp="{word_type}">
-""".format(word_type=word_type))
-                for i in inflections:
-                    to.write(
 """
+IFORM_TEMPLATE = """
                     <idx:iform name="{infl_type}" value="{value}"/>
-""".format(infl_type=i[0], value=i[1]))                
-                to.write(
-"""                
+"""
+INFL_END = """                
                 </idx:infl>
-""")
-        to.write(
-"""         </idx:orth>
+"""
+ORTH_END = """         </idx:orth>
           </h2>
-""")
-        d = '; '.join(ndefn for _, ndefn, _, _, _ in defs)
-        to.write(d)
-        to.write(
 """
+ENTRY_END = """
       </idx:entry>
 """
-)
 
-    if VERBOSE: print(key)
+# Split template into its literal text around the fields, so
+# rendering is a join of the literals and the field values
+# instead of a format call.
+def compiletemplate(template):
+    parsed = list(string.Formatter().parse(template))
+    literals = [literal for literal, _, _, _ in parsed]
+    if parsed[-1][1] is not None:
+        # The template ends with a field
+        literals.append('')
+    return tuple(literals)
 
-# Write all the keys, where defns is a map of
-# key --> [[term, defn, key==term]...]
-# and name is the basename
-# The files are split so that there are no more than
+ENTRY = compiletemplate(ENTRY_TEMPLATE)
+INFL = compiletemplate(INFL_TEMPLATE)
+IFORM = compiletemplate(IFORM_TEMPLATE)
+
+# The markup of key and its entries defn, built with a single join.
+def renderkey(key, defn):
+    parts = []
+    append = parts.append
+    extend = parts.extend
+    terms = iter(sorted(defn, key=keyf))
+    for term, g in groupby(terms, key=lambda entry: entry.term):
+        defs = list(g)
+        extend((ENTRY[0], key, ENTRY[1], term, ENTRY[2]))
+        # Now write any inflections we know of
+        for entry in defs:
+            if entry.inflections:
+                extend((INFL[0], entry.word_type, INFL[1]))
+                for form, value in entry.inflections:
+                    extend((IFORM[0], form, IFORM[1], value, IFORM[2]))
+                append(INFL_END)
+        append(ORTH_END)
+        append('; '.join(entry.defn for entry in defs))
+        append(ENTRY_END)
+    return ''.join(parts)
+
+# UTF-8 size of the literal text of a template
+def literalbytes(literals):
+    return sum(len(literal.encode('utf-8')) for literal in literals)
+
+ENTRY_BYTES = literalbytes(ENTRY) + literalbytes((ORTH_END, ENTRY_END))
+INFL_BYTES = literalbytes(INFL) + literalbytes((INFL_END,))
+IFORM_BYTES = literalbytes(IFORM)
+KEYFILE_BYTES = literalbytes((KEYFILE_HEAD, KEYFILE_TAIL))
+
+# Number of iforms written for the entries defn
+def keyiforms(defn):
+    return sum(len(entry.inflections) for entry in defn if entry.inflections)
+
+# Size in bytes of renderkey(key, defn) encoded as UTF-8,
+# without building the markup
+def keybytes(key, defn):
+    keylen = len(key.encode('utf-8'))
+    terms = set()
+    n = 0
+    for entry in defn:
+        if entry.term not in terms:
+            terms.add(entry.term)
+            n += ENTRY_BYTES + keylen + len(entry.term.encode('utf-8'))
+        else:
+            n += 2 # '; ' between definitions of a term
+        n += len(entry.defn.encode('utf-8'))
+        if entry.inflections:
+            n += INFL_BYTES + len(entry.word_type.encode('utf-8'))
+            for form, value in entry.inflections:
+                n += (IFORM_BYTES + len(form.encode('utf-8')) +
+                      len(value.encode('utf-8')))
+    return n
+
+# Output files are written with large buffered writes
+WRITE_BUFFER = 1 << 20
+
+# The key files are split so that there are no more than
 # 10,000 keys written to each file (why?? I dunno)
+KEYS_PER_FILE = 10000
+
+# Split the (key, defn) groups into the key files. A file
+# ends after max_keys keys, or before a key that would take it
+# over max_bytes bytes or max_iforms iforms (0 for no limit).
+# Every file gets at least one key, so a single key larger than
+# the limits gets a file of its own.
 #
-# Returns the number of files.
-def writekeys(defns, name):
-    keyit = iter(sorted(defns))
-    for j in count():
-        with writekeyfile(name, j) as to:
-            keys = list(islice(keyit, 10000))
-            if len(keys) == 0: break
-            for key in keys:
-                writekey(to, key, defns[key])
-    return j+1
-
-# After writing keys, the opf that references all the key files
-# is constructed.
-# openopf wraps the contents of writeopf
-#
-@contextmanager
-def openopf(ndicts, name):
-    fname = "%s.opf" % name
-    if VERBOSE: print("Opf: {}".format(fname))
-    with open(fname, 'w') as to:
-        to.write("""<?xml version="1.0"?><!DOCTYPE package SYSTEM "oeb1.ent">
+# Yields lists of (key, defn) pairs.
+def splitshards(groups, max_keys, max_bytes=0, max_iforms=0):
+    shard = []
+    nbytes = KEYFILE_BYTES
+    niforms = 0
+    for key, defn in groups:
+        b = keybytes(key, defn) if max_bytes else 0
+        i = keyiforms(defn) if max_iforms else 0
+        if shard and (len(shard) >= max_keys or
+                      max_bytes and nbytes + b > max_bytes or
+                      max_iforms and niforms + i > max_iforms):
+            yield shard
+            shard = []
+            nbytes = KEYFILE_BYTES
+            niforms = 0
+        shard.append((key, defn))
+        nbytes += b
+        niforms += i
+    if shard: yield shard
+
+# Name of key file i
+def keyfile(name, i):
+    return "{}{}.html".format(name, i)
+
+# Content hash of the (key, defn) pairs of a key file.
+# The inflections only depend on the key and word type,
+# so they are left out.
+def shardhash(keys):
+    h = hashlib.sha1()
+    for key, defn in keys:
+        h.update(json.dumps([key, [entry.content() for entry in defn]])
+                 .encode('utf-8'))
+    return h.hexdigest()
+
+# Split the sorted keys into key files along the boundaries
+# of a previous build (the first key of each file), so that a
+# change in the input only touches the files covering it.
+# Returns a list of the keys of every old file, which may be
+# empty or too large now, see Builder.incrementalwrite.
+def reuseshards(keys, firsts):
+    shards = [[] for _ in firsts]
+    for key in keys:
+        shards[max(bisect.bisect_right(firsts, key) - 1, 0)].append(key)
+    return shards
+
+# Builds one dictionary as described by a Config. The getkey,
+# getdef and mapping members of the configured module are loaded
+# once, so a Builder (or a process calling build() repeatedly)
+# doesn't share any state between dictionaries.
+class Builder:
+    def __init__(self, config):
+        self.config = config
+        (self.getkey, self.getdef, self.mapping,
+         self.getkeys, self.getdefs) = importmod(config.module)
+        self.normalize = normalizetable(self.mapping)
+        self.normalizeescape = normalizeescapetable(self.mapping)
+        self.getinflections = grammar_fi.getinflections
+        self.stats = Stats()
+        self.cache = LRUCache(config.cache_size) if config.cache_size else None
+        self.store = None
+        if config.inflection_store:
+            self.store = InflectionStore(config.inflection_store)
+        if config.stats_json:
+            self.getkeys = Timed('getkey', self.getkeys, self.stats)
+            self.getdefs = Timed('getdef', self.getdefs, self.stats)
+            self.getinflections = Timed('getinflections',
+                                        self.getinflections, self.stats)
+
+    # Run the method called method in a worker process. Returns
+    # its result and the statistics collected by the worker.
+    def runtask(self, method, *args):
+        self.stats.clear()
+        try:
+            return getattr(self, method)(*args), self.stats
+        finally:
+            if self.store is not None: self.store.flush()
+
+    # Path of the output file fname
+    def outpath(self, fname):
+        return os.path.join(self.config.outdir, fname)
+
+    # Inflections of key, which is of word_type
+    def inflect(self, key, word_type):
+        if self.cache is None:
+            return self.storedinflections(key, word_type)
+        inflections = self.cache.get((key, word_type))
+        if inflections is not None:
+            self.stats.cache[0] += 1
+            return inflections
+        self.stats.cache[1] += 1
+        inflections = self.storedinflections(key, word_type)
+        self.cache.put((key, word_type), inflections)
+        return inflections
+
+    # Inflections of key from the persistent store, which are
+    # computed and stored if they aren't there yet
+    def storedinflections(self, key, word_type):
+        if self.store is None:
+            return packinflections(self.getinflections(key, word_type))
+        inflections = self.store.get(key, word_type)
+        if inflections is not None:
+            self.stats.store[0] += 1
+            return packinflections(inflections)
+        self.stats.store[1] += 1
+        inflections = self.getinflections(key, word_type)
+        self.store.put(key, word_type, inflections)
+        return packinflections(inflections)
+
+    # parse a single line into a (key, Entry) pair
+    # r is a tab split line
+    # Without inflect, the inflections are left as None
+    # to be filled in by inflectkeys.
+    def parsekey(self, r, inflect=True):
+        return self.parsebatch([r], inflect)[0]
+
+    # parse a list of lines into (key, Entry) pairs, in a worker
+    # process for --jobs. The getkey and getdef hooks see the
+    # terms and definitions of all lines at once, see importmod.
+    def parsebatch(self, lines, inflect=True):
+        terms = []
+        defns = []
+        for r in lines:
+            try: term, defn =  r.split('\t',1)
+            except ValueError:
+                print("Bad line: '{}'".format(r))
+                raise
+            terms.append(term.strip())
+            defns.append(defn)
+
+        defns = self.getdefs(defns)
+        keys = self.getkeys([term.translate(self.normalize) for term in terms])
+        if len(defns) != len(lines) or len(keys) != len(lines):
+            raise ValueError("Batch hooks returned {} keys and {} definitions "
+                             "for {} lines".format(len(keys), len(defns),
+                                                   len(lines)))
+        return [self.makerecord(term, key, defn, inflect)
+                for term, key, defn in zip(terms, keys, defns)]
+
+    # The (key, Entry) pair of term with key and defn as returned
+    # by the getkey and getdef hooks
+    def makerecord(self, term, key, defn, inflect=True):
+        defn = defn.\
+            replace("\\n","<br/>\n").\
+            strip().translate(ESCAPE)
+
+        split_defn = defn.split('\t', 3)
+        word_type = split_defn[1] if len(split_defn) > 1 else 'unknown'
+
+        # key is the 'translated' key, nkey is the
+        # normalized original key.
+        # Both are escaped not to produce any undesired html.
+        key = foldkey(key)
+        nkey = foldkey(term, self.normalizeescape)
+
+        if key == '':
+            raise Exception("Missing key {}".format(term))
+        if defn == '':
+            raise Exception("Missing definition {}".format(term))
+
+        if self.config.verbose: print(key, ":", term)
+
+        self.stats.lines += 1
+        inflections = self.inflect(key, word_type) if inflect else None
+        return key, Entry(term, defn, key == nkey, word_type, inflections)
+
+    # Parse lines in a pool of jobs worker processes, yielding
+    # the (key, entry) pairs in input order.
+    def parallelrecords(self, lines, jobs, inflect=True):
+        tasks = (('parsebatch', batch, inflect)
+                 for batch in batches(lines, BATCH_SIZE))
+        with ProcessPoolExecutor(jobs) as pool:
+            for records, stats in boundedmap(pool, self.runtask, tasks, 2*jobs):
+                self.stats.merge(stats)
+                yield from records
+
+    # Iterate over the input files one after the other, reading
+    # lines of
+    # term {tab} definition
+    # skips empty lines and commented out lines
+    def readlines(self, filenames):
+        for filename in filenames:
+            if self.config.verbose: print("Reading {}".format(filename))
+            with openinput(filename) as fr:
+                yield from filter(inclline, fr)
+
+    # readlines, in a thread of its own with --pipeline
+    def inputlines(self, filenames):
+        lines = self.readlines(filenames)
+        if self.config.pipeline and self.config.jobs <= 1:
+            lines = chain.from_iterable(prefetch(
+                batches(lines, BATCH_SIZE), self.config.pipeline, 'lines',
+                self.stats))
+        return lines
+
+    # yields the (key, entry) pairs of the input files in input order
+    def readrecords(self, inflect=True):
+        lines = self.inputlines(self.config.filenames)
+        if self.config.jobs > 1:
+            yield from self.parallelrecords(lines, self.config.jobs, inflect)
+        else:
+            for batch in batches(lines, BATCH_SIZE):
+                yield from self.parsebatch(batch, inflect)
+
+    # The (key, index, seq, entry) records of the input file
+    # filename, which must be sorted by key. index is the
+    # position of the file on the command line and seq the
+    # position of the entry in the file, which keep the entries
+    # of a key in the order of readkeys when merging.
+    # The inflections are left out, see mergegroups.
+    def sortedrecords(self, filename, index):
+        records = chain.from_iterable(
+            self.parsebatch(batch, inflect=False)
+            for batch in batches(self.inputlines([filename]), BATCH_SIZE))
+        for seq, (key, entry) in enumerate(checkorder(records, filename)):
+            yield key, index, seq, entry
+
+    # k-way merge of the input files, which must each be sorted
+    # by key (the key after getkey and normalization, in python
+    # string order). Only the current line of every file is held
+    # in memory, there is no dict of all keys and no sorting.
+    # The inflections are computed while writing (in the worker
+    # processes with --jobs).
+    # A single file needs no merging at all, its records are just
+    # grouped as they come, and with --jobs its lines are parsed
+    # by a pool of workers as well.
+    #
+    # Yields (key, [Entry...]) in the order of sorted(defns).
+    # Raises InputOrderError as soon as a key is smaller than
+    # the one before in its file.
+    def mergegroups(self):
+        filenames = self.config.filenames
+        if len(filenames) == 1:
+            records = checkorder(self.readrecords(inflect=False), filenames[0])
+        else:
+            merged = heapq.merge(*(self.sortedrecords(filename, i)
+                                   for i, filename in enumerate(filenames)))
+            records = ((key, entry) for key, _, _, entry in merged)
+
+        # The split into key files depends on the size of the
+        # inflections with these limits
+        inflect = self.config.shard_bytes or self.config.shard_iforms
+        for key, g in groupby(records, key=itemgetter(0)):
+            defn = [entry for _, entry in g]
+            if inflect: self.inflectkeys([(key, defn)])
+            yield key, defn
+
+    # Read all of the input file into a map of
+    # key --> [Entry...]
+    def readkeys(self, inflect=True):
+        defns = {}
+        for key, entry in self.readrecords(inflect):
+            if key in defns: defns[key].append(entry)
+            else:            defns[key] = [entry]
+        return defns
+
+    # Write a sorted run of (key, seq, entry) records to a temporary
+    # file in tmpdir. Returns the file name.
+    def spillrun(self, run, tmpdir):
+        run.sort()
+        if self.config.verbose:
+            print("Spilling {} entries".format(len(run)))
+        return writerun(run, tmpdir)
+
+    # Merge the run files until there are no more than MERGE_RUNS
+    # of them, merging up to MERGE_RUNS at a time into a new run,
+    # so that only that many files are open at once.
+    # Returns the remaining run files.
+    def mergeruns(self, runs, tmpdir):
+        while len(runs) > MERGE_RUNS:
+            if self.config.verbose:
+                print("Merging {} runs".format(len(runs)))
+            merged = []
+            for i in range(0, len(runs), MERGE_RUNS):
+                group = runs[i:i + MERGE_RUNS]
+                if len(group) == 1:
+                    merged.append(group[0])
+                    continue
+                merged.append(writerun(
+                    heapq.merge(*(readrun(r) for r in group)), tmpdir))
+                for r in group:
+                    os.remove(r)
+            runs = merged
+        return runs
+
+    # External merge sort of (key, entry) records. At most budget
+    # records are held in memory, everything else is spilled to
+    # sorted runs which are k-way merged afterwards.
+    # The input position is part of the sort key, so that
+    # entries of a key keep their input order, just like in
+    # the dict built by readkeys.
+    #
+    # Yields (key, [Entry...]) in the order of sorted(defns).
+    def externalsort(self, records, budget):
+        with tempfile.TemporaryDirectory(prefix='tab2opf') as tmpdir:
+            runs = []
+            run = []
+            with self.stats.phase('read'):
+                for seq, (key, entry) in enumerate(records):
+                    run.append((key, seq, entry))
+                    if len(run) >= budget:
+                        runs.append(self.spillrun(run, tmpdir))
+                        run = []
+                run.sort()
+
+            runs = self.mergeruns(runs, tmpdir)
+            merged = heapq.merge(run, *(readrun(r) for r in runs))
+            for key, g in groupby(merged, key=itemgetter(0)):
+                yield key, [entry for _, _, entry in g]
+
+    # Write to key file {name}{n}.html
+    # put the body inside the context manager
+    @contextmanager
+    def writekeyfile(self, name, i):
+        fname = keyfile(name, i)
+        if self.config.verbose: print("Key file: {}".format(fname))
+        with open(self.outpath(fname), 'w', encoding='utf-8',
+                  buffering=WRITE_BUFFER) as to:
+            to.write(KEYFILE_HEAD)
+            try: yield to
+            finally:
+                to.write(KEYFILE_TAIL)
+        self.stats.shards[fname] = os.path.getsize(self.outpath(fname))
+
+    # Write into to the key, definition pairs
+    # key -> [Entry...]
+    def writekey(self, to, key, defn):
+        to.write(renderkey(key, defn))
+        if self.config.verbose: print(key)
+
+    # Write the (key, defn) pairs in keys to key file j
+    def writeshard(self, name, j, keys):
+        if self.config.estimate_only:
+            self.stats.addkeyfile(keyfile(name, j), keys)
+            return
+        with self.writekeyfile(name, j) as to:
+            for key, defn in keys:
+                self.writekey(to, key, defn)
+        if self.config.stats_json:
+            self.stats.addkeyfile(keyfile(name, j), keys)
+
+    # Fill in the inflections left out by parsekey(r, inflect=False)
+    # and write key file j
+    def inflectshard(self, name, j, keys):
+        self.inflectkeys(keys)
+        self.writeshard(name, j, keys)
+
+    # Fill in the inflections of the (key, defn) pairs in keys
+    def inflectkeys(self, keys):
+        for key, defn in keys:
+            for entry in defn:
+                if entry.inflections is None:
+                    entry.inflections = self.inflect(key, entry.word_type)
+
+    # Write the key files in a pool of jobs worker processes.
+    # Every file only depends on its own contiguous slice of
+    # keys, so they can be rendered independently.
+    # writer is the name of the method writing a file.
+    #
+    # Returns the number of files.
+    def parallelshards(self, shards, name, jobs, writer):
+        n = 0
+        tasks = ((writer, name, j, keys) for j, keys in shards)
+        with ProcessPoolExecutor(jobs) as pool:
+            for _, stats in boundedmap(pool, self.runtask, tasks, 2*jobs):
+                self.stats.merge(stats)
+                n += 1
+        return n
+
+    # Write the key files in a thread of its own, while this one
+    # goes on parsing (presorted input) or splitting the keys.
+    # Only one thread computes inflections at any time: the writer
+    # is writeshard unless the keys are read without inflections.
+    #
+    # Returns the number of files.
+    def pipelineshards(self, shards, name, writer):
+        write = getattr(self, writer)
+        n = 0
+        with Consumer(lambda shard: write(name, *shard), self.config.pipeline,
+                      'keyfiles', self.stats) as consumer:
+            for shard in shards:
+                consumer.put(shard)
+                n += 1
+        return n
+
+    # Split groups into key files according to the
+    # configured limits
+    def splitshards(self, groups):
+        return splitshards(groups, KEYS_PER_FILE, self.config.shard_bytes,
+                           self.config.shard_iforms)
+
+    # Write key files from (j, keys) pairs using the
+    # method called writer, writer(name, j, keys)
+    #
+    # Returns the number of files.
+    def writeshards(self, shards, name, writer):
+        if self.config.jobs > 1:
+            return self.parallelshards(shards, name, self.config.jobs, writer)
+        if self.config.pipeline:
+            return self.pipelineshards(shards, name, writer)
+        n = 0
+        for j, keys in shards:
+            getattr(self, writer)(name, j, keys)
+            n += 1
+        return n
+
+    # Write all the keys, where groups is an iterable of
+    # (key, [Entry...]) in key order
+    # and name is the basename
+    # writer is the method writing a key file, see writeshards
+    # A last key file without any keys is always written.
+    #
+    # Returns the number of files.
+    def writegroups(self, groups, name, writer='writeshard'):
+        shards = enumerate(self.splitshards(groups))
+        n = self.writeshards(shards, name, writer)
+        self.writeshard(name, n, [])
+        return n+1
+
+    # Write all the keys, where defns is a map of
+    # key --> [Entry...]
+    # and name is the basename
+    #
+    # Returns the number of files.
+    def writekeys(self, defns, name):
+        return self.writegroups(((key, defns[key]) for key in sorted(defns)), name)
+
+    # After writing keys, the opf that references all the key files
+    # is constructed.
+    # openopf wraps the contents of writeopf
+    #
+    @contextmanager
+    def openopf(self, ndicts, name):
+        fname = "%s.opf" % name
+        if self.config.verbose: print("Opf: {}".format(fname))
+        with open(self.outpath(fname), 'w', encoding='utf-8',
+                  buffering=WRITE_BUFFER) as to:
+            to.write("""<?xml version="1.0"?><!DOCTYPE package SYSTEM "oeb1.ent">
 
 <!-- the command line instruction 'prcgen dictionary.opf' will produce the dictionary.prc file in the same folder-->
 <!-- the command line instruction 'mobigen dictionary.opf' will produce the dictionary.mobi file in the same folder-->
@@ -314,51 +1374,390 @@ def openopf(ndicts, name):
 
 <!-- list of all the files needed to produce the .prc file -->
 <manifest>
-""".format(name=name, source=INLANG, target=OUTLANG))
+""".format(name=name, source=self.config.source, target=self.config.target))
 
-        yield to
+            yield to
 
-        to.write("""
+            to.write("""
 <tours/>
 <guide> <reference type="search" title="Dictionary Search" onclick= "index_search()"/> </guide>
 </package>
 """
 )
 
-# Write the opf that describes all the key files
-def writeopf(ndicts, name):
-    with openopf(ndicts, name) as to:
-        to.write(
+    # Write the opf that describes all the key files, which
+    # are the files 0 to ndicts-1 unless their numbers are
+    # given in order as ids
+    def writeopf(self, ndicts, name, ids=None):
+        if ids is None:
+            ids = range(ndicts)
+        with self.openopf(ndicts, name) as to:
+            to.write(
 """     <item id="cover" href="cover.jpg" media-type="image/jpeg"/>
 """)
-        for i in range(ndicts):
-            to.write(
+            for i in ids:
+                to.write(
 """     <item id="dictionary{ndict}" href="{name}{ndict}.html" media-type="text/x-oeb1-document"/>
 """.format(ndict=i, name=name))
 
-        to.write("""
+            to.write("""
 </manifest>
 <!-- list of the html files in the correct order  -->
 <spine>
         <itemref idref="cover"/>
 """)
-        for i in range(ndicts):
-            to.write("""
+            for i in ids:
+                to.write("""
 	<itemref idref="dictionary{ndict}"/>
 """.format(ndict=i))
 
-        to.write("""
+            to.write("""
 </spine>
 """)
 
+
+    # Name of the manifest describing the key files of
+    # an incremental build
+    def manifestpath(self, name):
+        return self.outpath("{}.manifest.json".format(name))
+
+    # Settings that go into every key file. Key files
+    # written with other settings can't be reused.
+    def settings(self):
+        return {'version': VERSION, 'module': self.config.module,
+                'source': self.config.source, 'target': self.config.target,
+                'grammar': grammar_fi.rules_version(),
+                'keys_per_file': KEYS_PER_FILE,
+                'shard_bytes': self.config.shard_bytes,
+                'shard_iforms': self.config.shard_iforms}
+
+    # The manifest of the previous incremental build, or
+    # None if there is no usable one.
+    def loadmanifest(self, name):
+        try:
+            with open(self.manifestpath(name), encoding='utf-8') as fr:
+                manifest = json.load(fr)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('settings') != self.settings():
+            return None
+        return manifest
+
+    # Save the manifest of an incremental build: the entries of
+    # its key files in key order and the number of the empty key
+    # file after them
+    def savemanifest(self, name, shards, empty):
+        fname = self.manifestpath(name)
+        with open(fname + '.tmp', 'w', encoding='utf-8') as to:
+            json.dump({'settings': self.settings(), 'shards': shards,
+                       'empty': empty}, to, indent=1)
+        os.replace(fname + '.tmp', fname)
+
+    # Incremental build. The manifest records the key range
+    # and content hash of every key file. The key files keep
+    # the boundaries of the previous build, and only the ones
+    # whose entries changed are written again, which is also
+    # the only place inflections are computed. Every key file
+    # has a number of its own, so that splitting a file that
+    # grew too large only adds files and doesn't renumber the
+    # ones after it. The opf is only written again if the list
+    # of key files changes.
+    #
+    # Returns the number of files.
+    def incrementalbuild(self, name):
+        print("Reading keys")
+        with self.stats.phase('read'):
+            defns = self.readkeys(inflect=False)
+        with self.stats.phase('write'):
+            return self.incrementalwrite(defns, name)
+
+    # The size of the key file of the (key, defn) pairs as the
+    # dict {'bytes': ..., 'iforms': ...}. Fills in the
+    # inflections it depends on.
+    def shardsize(self, pairs):
+        self.inflectkeys(pairs)
+        return {'bytes': KEYFILE_BYTES + sum(keybytes(key, defn)
+                                             for key, defn in pairs),
+                'iforms': sum(keyiforms(defn) for _, defn in pairs)}
+
+    # Whether a key file of size (see shardsize) exceeds the
+    # configured shard_bytes or shard_iforms
+    def overlimits(self, size):
+        return bool(self.config.shard_bytes and
+                    size['bytes'] > self.config.shard_bytes or
+                    self.config.shard_iforms and
+                    size['iforms'] > self.config.shard_iforms)
+
+    # Split the (key, defn) pairs into key files, the first of
+    # which is numbered first and the others get the numbers from
+    # ids. Returns a list of (number, pairs, size), where size is
+    # None unless shard_bytes or shard_iforms is set.
+    # With balanced, the files all get about the same share of
+    # the keys, bytes and iforms instead of all but the last
+    # being filled up to the limits, which leaves room for keys
+    # added to them later.
+    def splitfile(self, first, pairs, ids, balanced=False):
+        limited = self.config.shard_bytes or self.config.shard_iforms
+        if limited:
+            # The split depends on the size of the inflections
+            self.inflectkeys(pairs)
+        shards = list(self.splitshards(pairs))
+        if balanced and len(shards) > 1:
+            n = len(shards)
+            size = self.shardsize(pairs) if limited else None
+            even = list(splitshards(
+                pairs, -(-len(pairs) // n),
+                self.config.shard_bytes and min(
+                    self.config.shard_bytes,
+                    KEYFILE_BYTES + -(-(size['bytes'] - KEYFILE_BYTES) // n)),
+                self.config.shard_iforms and min(
+                    self.config.shard_iforms, -(-size['iforms'] // n))))
+            if len(even) == n:
+                shards = even
+        files = []
+        for shard in shards:
+            files.append((first if not files else next(ids), shard,
+                          self.shardsize(shard) if limited else None))
+        return files
+
+    # The key files of this build as a list of (number, pairs,
+    # size, changed) in key order, given the manifest entries
+    # of the previous build in old (see incrementalwrite).
+    # Keys go into the old file of their key range. A file that
+    # lost all its keys is dropped, one that gets more than
+    # KEYS_PER_FILE keys or exceeds shard_bytes or shard_iforms
+    # is split, with new numbers from ids for all but its first
+    # part. Unchanged files keep the size recorded in the
+    # manifest, the others (and files of manifests without
+    # sizes) are inflected to measure them.
+    def reusefiles(self, keys, defns, old, ids, name):
+        limited = self.config.shard_bytes or self.config.shard_iforms
+        files = []
+        for skeys, entry in zip(reuseshards(keys, [e['first'] for e in old]),
+                                old):
+            if not skeys: continue
+            pairs = [(key, defns[key]) for key in skeys]
+            fname = self.outpath(keyfile(name, entry['id']))
+            unchanged = (shardhash(pairs) == entry['hash'] and
+                         os.path.exists(fname))
+            size = None
+            if limited:
+                if unchanged and 'bytes' in entry:
+                    size = {'bytes': entry['bytes'],
+                            'iforms': entry['iforms']}
+                else:
+                    size = self.shardsize(pairs)
+            if (len(skeys) > 1 and (len(skeys) > KEYS_PER_FILE or
+                                    limited and self.overlimits(size))):
+                files.extend(f + (True,) for f in self.splitfile(
+                    entry['id'], pairs, ids, balanced=True))
+            else:
+                files.append((entry['id'], pairs, size, not unchanged))
+        return files
+
+    # Write the key files of an incremental build, see
+    # incrementalbuild
+    def incrementalwrite(self, defns, name):
+        keys = sorted(defns)
+
+        manifest = self.loadmanifest(name)
+        old = manifest['shards'] if manifest else []
+        # Manifests of older builds number the files in order
+        for j, entry in enumerate(old):
+            entry.setdefault('id', j)
+        # The numbers of the old key files, the empty one last
+        oldids = [e['id'] for e in old]
+        if manifest is not None:
+            oldids.append(manifest.get('empty', len(old)))
+        newids = count(max(oldids, default=-1) + 1)
+
+        if old:
+            files = self.reusefiles(keys, defns, old, newids, name)
+        else:
+            files = [f + (True,) for f in self.splitfile(
+                next(newids), [(key, defns[key]) for key in keys], newids)]
+        # A new build numbers the files in order, like writegroups
+        empty = oldids[-1] if oldids else len(files)
+
+        entries = []
+        changed = []
+        for j, pairs, size, modified in files:
+            entries.append({'id': j, 'first': pairs[0][0],
+                            'last': pairs[-1][0], 'keys': len(pairs),
+                            'hash': shardhash(pairs)})
+            if size is not None:
+                entries[-1].update(size)
+            if modified:
+                changed.append((j, pairs))
+
+        print("Writing keys ({} of {} files changed)".format(
+            len(changed), len(files)))
+        self.writeshards(changed, name, 'inflectshard')
+
+        ids = [e['id'] for e in entries] + [empty]
+        relist = ids != oldids
+        if (manifest is None or
+            not os.path.exists(self.outpath(keyfile(name, empty)))):
+            self.writeshard(name, empty, [])
+        if relist or not os.path.exists(self.outpath("%s.opf" % name)):
+            print("Writing opf")
+            with self.stats.phase('opf'):
+                self.writeopf(len(ids), name, ids)
+        # Remove the key files of the previous build that are
+        # no longer part of the dictionary
+        for j in set(oldids) - set(ids):
+            fname = self.outpath(keyfile(name, j))
+            if os.path.exists(fname):
+                os.remove(fname)
+        self.savemanifest(name, entries, empty)
+        return len(ids)
+
+    # Read the input and write all key files and the opf,
+    # profiling the build and writing its statistics as
+    # configured.
+    #
+    # Returns the number of key files.
+    def build(self):
+        if not self.config.estimate_only:
+            os.makedirs(self.config.outdir or '.', exist_ok=True)
+        stdout = sys.stdout
+        with progressoutput(self.config):
+            if self.store is not None:
+                self.store.prune()
+            try:
+                if self.config.profile:
+                    profile = cProfile.Profile()
+                    ndicts = profile.runcall(self.runbuild)
+                    profile.dump_stats(self.config.profile)
+                else:
+                    ndicts = self.runbuild()
+            finally:
+                if self.store is not None: self.store.close()
+        if self.config.stats_json:
+            self.writestats(self.config.stats_json, stdout)
+        return ndicts
+
+    def runbuild(self):
+        name = self.config.name
+        if self.config.estimate_only:
+            # The estimate covers all of the output, incremental
+            # or not
+            if self.config.presorted:
+                ndicts = self.sortedwrite(name)
+            else:
+                ndicts = self.sortwrite(name)
+            self.printestimate(ndicts)
+            return ndicts
+        if self.config.incremental:
+            return self.incrementalbuild(name)
+        # The key files written now no longer match the manifest
+        # of an earlier incremental build
+        if os.path.exists(self.manifestpath(name)):
+            os.remove(self.manifestpath(name))
+        if self.config.presorted:
+            ndicts = self.sortedwrite(name)
+        else:
+            ndicts = self.sortwrite(name)
+        print("Writing opf")
+        with self.stats.phase('opf'):
+            self.writeopf(ndicts, name)
+        return ndicts
+
+    # Write the key files of input that is sorted by key, see
+    # mergegroups. If it turns out not to be, the key files
+    # are written again by sortwrite, unless the configuration
+    # asks for strict order or the input can't be read twice.
+    #
+    # Returns the number of key files.
+    def sortedwrite(self, name):
+        print("Reading and writing keys (merging sorted input)")
+        try:
+            with self.stats.phase('write'):
+                return self.writegroups(self.mergegroups(), name,
+                                        'inflectshard')
+        except InputOrderError as e:
+            if self.config.strict_order or '-' in self.config.filenames:
+                raise
+            print("{}, sorting instead".format(e))
+        # Only count what the sorting pass does
+        self.stats.clear()
+        return self.sortwrite(name)
+
+    # Write the key files, sorting the input first
+    #
+    # Returns the number of key files.
+    def sortwrite(self, name):
+        if self.config.sort_budget > 0:
+            print("Reading and writing keys (external sort)")
+            records = self.readrecords()
+            with self.stats.phase('write'):
+                ndicts = self.writegroups(
+                    self.externalsort(records, self.config.sort_budget), name)
+        else:
+            print("Reading keys")
+            with self.stats.phase('read'):
+                defns = self.readkeys()
+            print("Writing keys")
+            with self.stats.phase('write'):
+                ndicts = self.writekeys(defns, name)
+        return ndicts
+
+    # Print a summary of the output accounted for in the
+    # statistics: the size of the key files, the number of
+    # iforms per word type and the largest keys
+    def printestimate(self, ndicts):
+        output = self.stats.output()
+        print("Key files:  {}".format(ndicts))
+        print("Headwords:  {}".format(output['headwords']))
+        print("Entries:    {}".format(output['entries']))
+        print("Iforms:     {}".format(output['iforms']))
+        print("Html bytes: {}".format(output['bytes']))
+        print("Iforms per entry by word type:")
+        for word_type, counts in sorted(output['inflections'].items()):
+            entries = sum(counts.values())
+            iforms = sum(n * e for n, e in counts.items())
+            print("  {:12} {:8} entries, mean {:.1f}, max {}".format(
+                word_type, entries, iforms / entries, max(counts)))
+        print("Largest headwords:")
+        for largest in output['largest']:
+            print("  {:10} bytes  {}".format(largest['bytes'], largest['key']))
+
+    # Write the statistics of the build as JSON to fname,
+    # - for stdout (or the stream given as stdout)
+    def writestats(self, fname, stdout=None):
+        report = self.stats.report()
+        if fname == '-':
+            stdout = stdout or sys.stdout
+            json.dump(report, stdout, indent=1)
+            stdout.write('\n')
+        else:
+            with open(fname, 'w', encoding='utf-8') as to:
+                json.dump(report, to, indent=1)
+
+# Progress messages go to stdout, unless the statistics of the
+# build are written there: then they go to stderr, so that stdout
+# only has the JSON report. Wraps loading the module and building.
+def progressoutput(config):
+    if config.stats_json == '-':
+        return redirect_stdout(sys.stderr)
+    return nullcontext()
+
+# Build the dictionary described by config.
+# Returns the number of key files.
+def build(config):
+    with progressoutput(config):
+        builder = Builder(config)
+    return builder.build()
+
 ######################################################
 # main
 ######################################################
 
-print("Reading keys")
-defns = readkeys()
-name = os.path.splitext(os.path.basename(FILENAME))[0]
-print("Writing keys")
-ndicts = writekeys(defns, name)
-print("Writing opf")
-writeopf(ndicts, name)
+def main(argv=None):
+    try:
+        build(Config.fromargs(parseargs(argv)))
+    except InputOrderError as e:
+        sys.exit("tab2opf: {}".format(e))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,524 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Test cases for the dictionary builder.
+
+import bz2
+import gzip
+import io
+import json
+import lzma
+import os
+import random
+import re
+import tempfile
+import types
+import unittest
+from unittest import mock
+from xml.sax.saxutils import escape
+import tab2opf
+
+TAB = """# Test dictionary
+antaa\tto give\tverb
+pöytä\ttable\tnoun
+
+talo\thouse\tnoun
+Talo\tbuilding\tnoun
+"""
+
+class TestBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.filename = os.path.join(self.tmpdir.name, 'test.tab')
+        with open(self.filename, 'w', encoding='utf-8') as to:
+            to.write(TAB)
+
+    def config(self, **kwargs):
+        outdir = os.path.join(self.tmpdir.name, 'out')
+        os.makedirs(outdir, exist_ok=True)
+        return tab2opf.Config(self.filename, module='grammar_fi',
+                              outdir=outdir, **kwargs)
+
+    def read(self, config, fname):
+        with open(os.path.join(config.outdir, fname), encoding='utf-8') as fr:
+            return fr.read()
+
+    # The key files listed in the opf of config, in order
+    def opffiles(self, config, name='test'):
+        return re.findall(r'href="({}\d+\.html)"'.format(name),
+                          self.read(config, name + '.opf'))
+
+    # The keys of the key files listed in the opf of config, in order
+    def opfkeys(self, config):
+        keys = []
+        for fname in self.opffiles(config):
+            keys.append(re.findall('<idx:orth value="([^"]*)"',
+                                   self.read(config, fname)))
+        return keys
+
+    def test_build(self):
+        config = self.config()
+        self.assertEqual(tab2opf.build(config), 2)
+        html = self.read(config, 'test0.html')
+        self.assertIn('<idx:orth value="antaa">antaa', html)
+        self.assertIn('<idx:iform name="1ps present" value="annan"/>', html)
+        self.assertIn('table', html)
+        self.assertEqual(html.count('<idx:orth value="talo">'), 2)
+        self.assertIn('href="test1.html"', self.read(config, 'test.opf'))
+
+    def test_new_outdir(self):
+        outdir = os.path.join(self.tmpdir.name, 'new', 'out')
+        config = tab2opf.Config(self.filename, module='grammar_fi',
+                                outdir=outdir)
+        self.assertEqual(tab2opf.build(config), 2)
+        self.assertIn('antaa', self.read(config, 'test0.html'))
+
+    def test_repeated_builds(self):
+        config = self.config()
+        tab2opf.build(config)
+        first = self.read(config, 'test0.html')
+        tab2opf.build(config)
+        self.assertEqual(self.read(config, 'test0.html'), first)
+
+    def test_external_sort(self):
+        config = self.config()
+        tab2opf.build(config)
+        expected = self.read(config, 'test0.html')
+        config = self.config(sort_budget=1)
+        tab2opf.build(config)
+        self.assertEqual(self.read(config, 'test0.html'), expected)
+
+    def test_external_sort_many_runs(self):
+        words = ['sana{:03}'.format(i) for i in range(200)]
+        random.Random(1).shuffle(words)
+        with open(self.filename, 'w', encoding='utf-8') as to:
+            for word in words:
+                to.write('{}\tword\tnoun\n'.format(word))
+        config = self.config()
+        tab2opf.build(config)
+        expected = self.read(config, 'test0.html')
+        # 200 runs, merged in passes of at most 3 open files
+        readrun = tab2opf.readrun
+        reading = []
+        peak = [0]
+        def countrun(fname):
+            reading.append(fname)
+            peak[0] = max(peak[0], len(reading))
+            try: yield from readrun(fname)
+            finally: reading.remove(fname)
+        with mock.patch('tab2opf.MERGE_RUNS', 3), \
+             mock.patch('tab2opf.readrun', countrun):
+            config = self.config(sort_budget=1)
+            tab2opf.build(config)
+        self.assertEqual(self.read(config, 'test0.html'), expected)
+        self.assertEqual(peak[0], 3)
+
+    @mock.patch('tab2opf.KEYS_PER_FILE', 2)
+    def test_incremental(self):
+        config = self.config(incremental=True)
+        self.assertEqual(tab2opf.build(config), 3)
+        # Mark the key files, so we can tell which ones get rewritten.
+        for i in range(3):
+            with open(os.path.join(config.outdir, 'test{}.html'.format(i)),
+                      'w') as to:
+                to.write('untouched')
+
+        with open(self.filename, 'w', encoding='utf-8') as to:
+            to.write(TAB.replace('to give', 'to hand'))
+        self.assertEqual(tab2opf.build(config), 3)
+        self.assertIn('to hand', self.read(config, 'test0.html'))
+        self.assertEqual(self.read(config, 'test1.html'), 'untouched')
+        self.assertEqual(self.read(config, 'test2.html'), 'untouched')
+
+    def test_incremental_after_full_build(self):
+        config = self.config(incremental=True)
+        tab2opf.build(config)
+        other = os.path.join(self.tmpdir.name, 'other.tab')
+        with open(other, 'w', encoding='utf-8') as to:
+            to.write('vene\tboat\tnoun\n')
+        tab2opf.build(tab2opf.Config(other, module='grammar_fi',
+                                     outdir=config.outdir, name='test'))
+        self.assertFalse(os.path.exists(
+            os.path.join(config.outdir, 'test.manifest.json')))
+        # Writes all of the files of test.tab again
+        tab2opf.build(config)
+        html = self.read(config, 'test0.html')
+        self.assertIn('antaa', html)
+        self.assertNotIn('vene', html)
+
+    @mock.patch('tab2opf.KEYS_PER_FILE', 2)
+    def test_incremental_shrink(self):
+        config = self.config(incremental=True)
+        self.assertEqual(tab2opf.build(config), 3)
+        with open(self.filename, 'w', encoding='utf-8') as to:
+            to.write('antaa\tto give\tverb\n')
+        self.assertEqual(tab2opf.build(config), 2)
+        self.assertEqual(self.opfkeys(config), [['antaa'], []])
+        # Only the files in the opf are left
+        self.assertEqual(
+            sorted(f for f in os.listdir(config.outdir) if f.endswith('.html')),
+            sorted(self.opffiles(config)))
+
+    @mock.patch('tab2opf.KEYS_PER_FILE', 2)
+    def test_incremental_keys_per_file(self):
+        config = self.config(incremental=True)
+        tab2opf.build(config)
+        # Mark the key files, so we can tell which ones get rewritten.
+        for fname in self.opffiles(config)[1:]:
+            with open(os.path.join(config.outdir, fname), 'w') as to:
+                to.write('untouched')
+        # Adding a key to the full first file splits it, but the
+        # files after it keep their numbers and aren't rewritten.
+        with open(self.filename, 'a', encoding='utf-8') as to:
+            to.write('aamu\tmorning\tnoun\n')
+        self.assertEqual(tab2opf.build(config), 4)
+        fnames = self.opffiles(config)
+        self.assertEqual(fnames[0], 'test0.html')
+        self.assertEqual(fnames[2:], ['test1.html', 'test2.html'])
+        self.assertEqual(self.read(config, 'test1.html'), 'untouched')
+        self.assertEqual(self.read(config, 'test2.html'), 'untouched')
+        self.assertIn('aamu', self.read(config, 'test0.html'))
+        self.assertIn('pöytä', self.read(config, fnames[1]))
+
+    def test_shard_bytes(self):
+        config = self.config(shard_bytes=4000)
+        ndicts = tab2opf.build(config)
+        self.assertGreater(ndicts, 2)
+        for i in range(ndicts - 1):
+            html = self.read(config, 'test{}.html'.format(i))
+            # A key file only exceeds the limit for a single key.
+            if html.count('<idx:orth ') > 1:
+                self.assertLessEqual(len(html.encode('utf-8')), 4000)
+
+    def test_incremental_shard_bytes(self):
+        config = self.config(incremental=True, shard_bytes=4000)
+        tab2opf.build(config)
+        # All of these go into the file of 'talo'
+        with open(self.filename, 'a', encoding='utf-8') as to:
+            for i in range(20):
+                to.write('talo{}\thouse {}\tnoun\n'.format(i, i))
+        ndicts = tab2opf.build(config)
+        self.assertGreater(ndicts, 3)
+        for fname in self.opffiles(config):
+            html = self.read(config, fname)
+            if html.count('<idx:orth ') > 1:
+                self.assertLessEqual(len(html.encode('utf-8')), 4000)
+
+    def test_incremental_split_shard_bytes(self):
+        with open(self.filename, 'w', encoding='utf-8') as to:
+            for i in range(60):
+                to.write('sana{:02}\tword {}\tnoun\n'.format(i, i))
+        config = self.config(incremental=True, shard_bytes=6000)
+        tab2opf.build(config)
+        before = self.opffiles(config)
+        self.assertGreater(len(before), 4)
+        for fname in before:
+            with open(os.path.join(config.outdir, fname), 'w') as to:
+                to.write('untouched')
+        # Overflow the file of sana30
+        with open(self.filename, 'a', encoding='utf-8') as to:
+            to.write('sana300\tanother word\tnoun\n')
+        tab2opf.build(config)
+        after = self.opffiles(config)
+        # The file is split in two, the other files keep their
+        # numbers and aren't rewritten
+        self.assertEqual(len(after), len(before) + 1)
+        self.assertEqual([f for f in after if f in before], before)
+        rewritten = [f for f in after
+                     if self.read(config, f) != 'untouched']
+        self.assertEqual(len(rewritten), 2)
+        self.assertTrue(any('sana300' in self.read(config, f)
+                            for f in rewritten))
+        for fname in rewritten:
+            self.assertLessEqual(
+                len(self.read(config, fname).encode('utf-8')), 6000)
+
+    def test_compressed_input(self):
+        config = self.config()
+        tab2opf.build(config)
+        expected = self.read(config, 'test0.html')
+        for compression in [gzip, bz2, lzma]:
+            filename = self.filename + '.z'
+            with compression.open(filename, 'wt', encoding='utf-8') as to:
+                to.write(TAB)
+            config = tab2opf.Config(filename, module='grammar_fi',
+                                    outdir=config.outdir, name='z')
+            tab2opf.build(config)
+            self.assertEqual(self.read(config, 'z0.html'), expected)
+
+    def test_chunked_stdin(self):
+        # A pipe that delivers the first bytes on their own
+        class Chunked(io.RawIOBase):
+            def __init__(self, data):
+                self.chunks = [data[:3], data[3:]]
+            def readable(self):
+                return True
+            def readinto(self, b):
+                if not self.chunks: return 0
+                chunk = self.chunks.pop(0)
+                b[:len(chunk)] = chunk
+                return len(chunk)
+        for data in [lzma.compress(TAB.encode('utf-8')),
+                     TAB.encode('utf-8'), b'ab']:
+            stdin = types.SimpleNamespace(
+                buffer=io.BufferedReader(Chunked(data)))
+            with mock.patch('sys.stdin', stdin):
+                with tab2opf.openinput('-') as fr:
+                    text = fr.read()
+            self.assertEqual(text, TAB if len(data) > 2 else 'ab')
+
+    # Split TAB into two files with every other line
+    def splitinput(self):
+        lines = [l + '\n' for l in TAB.splitlines() if tab2opf.inclline(l)]
+        filenames = []
+        for i in range(2):
+            filename = os.path.join(self.tmpdir.name, 'part{}.tab'.format(i))
+            with open(filename, 'w', encoding='utf-8') as to:
+                to.writelines(lines[i::2])
+            filenames.append(filename)
+        return filenames
+
+    def test_multiple_inputs(self):
+        config = self.config()
+        tab2opf.build(config)
+        expected = self.read(config, 'test0.html')
+        filenames = self.splitinput()
+        for presorted in [False, True]:
+            config = tab2opf.Config(filenames, module='grammar_fi',
+                                    outdir=config.outdir, name='m',
+                                    presorted=presorted)
+            self.assertEqual(tab2opf.build(config), 2)
+            self.assertEqual(self.read(config, 'm0.html'), expected)
+
+    def test_presorted_order(self):
+        with open(self.filename, 'a', encoding='utf-8') as to:
+            to.write('aamu\tmorning\tnoun\n')
+        config = self.config()
+        tab2opf.build(config)
+        expected = self.read(config, 'test0.html')
+        # Falls back to sorting
+        config = self.config(presorted=True)
+        tab2opf.build(config)
+        self.assertEqual(self.read(config, 'test0.html'), expected)
+        config = self.config(presorted=True, strict_order=True)
+        with self.assertRaises(tab2opf.InputOrderError):
+            tab2opf.build(config)
+
+    # Contents of all files written to outdir
+    def outputs(self, outdir):
+        files = {}
+        for fname in sorted(os.listdir(outdir)):
+            with open(os.path.join(outdir, fname), encoding='utf-8') as fr:
+                files[fname] = fr.read()
+        return files
+
+    @mock.patch('tab2opf.KEYS_PER_FILE', 500)
+    def test_jobs(self):
+        rng = random.Random(2)
+        words = ['antaa', 'pöytä', 'talo', 'tulla', 'vene', 'haluta']
+        with open(self.filename, 'w', encoding='utf-8') as to:
+            for i in range(3000):
+                word = rng.choice(words) + str(rng.randrange(1000))
+                to.write('{}\tmeaning {}\t{}\n'.format(
+                    word, i, rng.choice(['noun', 'verb'])))
+        builds = {}
+        for name, kwargs in [('serial', {}), ('jobs', {'jobs': 2}),
+                             ('sort', {'jobs': 2, 'sort_budget': 700})]:
+            outdir = os.path.join(self.tmpdir.name, name)
+            os.makedirs(outdir)
+            tab2opf.build(tab2opf.Config(self.filename, module='grammar_fi',
+                                         outdir=outdir, **kwargs))
+            builds[name] = self.outputs(outdir)
+        self.assertGreater(len(builds['serial']), 3)
+        self.assertEqual(builds['jobs'], builds['serial'])
+        self.assertEqual(builds['sort'], builds['serial'])
+
+    def test_presorted_fallback_stats(self):
+        with open(self.filename, 'a', encoding='utf-8') as to:
+            to.write('aamu\tmorning\tnoun\n')
+        reports = []
+        for presorted in [False, True]:
+            stats = os.path.join(self.tmpdir.name, 'stats.json')
+            config = self.config(stats_json=stats, estimate_only=True,
+                                 presorted=presorted)
+            tab2opf.build(config)
+            with open(stats) as fr:
+                report = json.load(fr)
+            reports.append((report['lines'], report['output']))
+        self.assertEqual(reports[1], reports[0])
+        self.assertEqual(reports[0][1]['entries'], 5)
+
+    def test_presorted_jobs(self):
+        config = self.config()
+        tab2opf.build(config)
+        expected = self.read(config, 'test0.html')
+        config = self.config(presorted=True, jobs=2)
+        tab2opf.build(config)
+        self.assertEqual(self.read(config, 'test0.html'), expected)
+
+    def test_stats_json(self):
+        stats = os.path.join(self.tmpdir.name, 'stats.json')
+        config = self.config(stats_json=stats)
+        tab2opf.build(config)
+        with open(stats) as fr:
+            report = json.load(fr)
+        self.assertEqual(set(report['phases']), {'read', 'write', 'opf'})
+        self.assertEqual(report['lines'], 4)
+        # talo and Talo share their inflections
+        self.assertEqual(report['hooks']['getinflections']['calls'], 3)
+        self.assertEqual(report['inflection_cache'],
+                         {'hits': 1, 'misses': 3})
+        self.assertEqual(report['shards']['test0.html'], os.path.getsize(
+            os.path.join(config.outdir, 'test0.html')))
+
+    def test_stats_json_stdout(self):
+        config = self.config(stats_json='-', estimate_only=True)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with mock.patch('sys.stdout', stdout), mock.patch('sys.stderr', stderr):
+            tab2opf.build(config)
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(report['lines'], 4)
+        self.assertIn('Loading methods from', stderr.getvalue())
+        self.assertIn('Headwords:', stderr.getvalue())
+
+    def test_inflection_cache(self):
+        builder = tab2opf.Builder(self.config(cache_size=1))
+        first = builder.inflect('antaa', 'verb')
+        self.assertIs(builder.inflect('antaa', 'verb'), first)
+        self.assertIsNot(builder.inflect('antaa', 'noun'), first)
+        # The cache only holds the last word
+        self.assertIsNot(builder.inflect('antaa', 'verb'), first)
+        self.assertEqual(builder.inflect('antaa', 'verb'), first)
+        self.assertEqual(builder.stats.cache, [2, 3])
+
+    def test_inflection_store(self):
+        store = os.path.join(self.tmpdir.name, 'store')
+        config = self.config(inflection_store=store)
+        tab2opf.build(config)
+        expected = self.read(config, 'test0.html')
+        stats = os.path.join(self.tmpdir.name, 'stats.json')
+        config = self.config(inflection_store=store, stats_json=stats)
+        tab2opf.build(config)
+        self.assertEqual(self.read(config, 'test0.html'), expected)
+        with open(stats) as fr:
+            report = json.load(fr)
+        self.assertEqual(report['inflection_store'], {'hits': 3, 'misses': 0})
+        self.assertNotIn('getinflections', report['hooks'])
+
+    def test_pipeline(self):
+        config = self.config()
+        tab2opf.build(config)
+        expected = self.read(config, 'test0.html')
+        stats = os.path.join(self.tmpdir.name, 'stats.json')
+        for presorted in [False, True]:
+            config = self.config(pipeline=1, presorted=presorted,
+                                 stats_json=stats)
+            tab2opf.build(config)
+            self.assertEqual(self.read(config, 'test0.html'), expected)
+            with open(stats) as fr:
+                queues = json.load(fr)['queues']
+            self.assertEqual(set(queues), {'lines', 'keyfiles'})
+            self.assertEqual(queues['keyfiles']['items'], 1)
+
+    def test_pipeline_error(self):
+        config = self.config(pipeline=1)
+        with mock.patch.object(tab2opf.Builder, 'writeshard',
+                               side_effect=OSError('disk full')):
+            with self.assertRaisesRegex(OSError, 'disk full'):
+                tab2opf.build(config)
+
+    def test_output_stats(self):
+        stats = os.path.join(self.tmpdir.name, 'stats.json')
+        config = self.config(stats_json=stats)
+        tab2opf.build(config)
+        with open(stats) as fr:
+            output = json.load(fr)['output']
+        self.assertEqual(output['bytes'], sum(
+            os.path.getsize(os.path.join(config.outdir, f))
+            for f in ['test0.html', 'test1.html']))
+        self.assertEqual(output['headwords'], 3)
+        self.assertEqual(output['entries'], 4)
+        self.assertEqual(output['keyfiles']['test1.html']['headwords'], 0)
+        self.assertEqual(set(output['inflections']), {'noun', 'verb'})
+        self.assertEqual(len(output['largest']), 3)
+
+        # The estimate is the same, without writing anything
+        outdir = os.path.join(self.tmpdir.name, 'estimate')
+        os.makedirs(outdir)
+        config = tab2opf.Config(self.filename, module='grammar_fi',
+                                outdir=outdir, estimate_only=True,
+                                stats_json=stats)
+        self.assertEqual(tab2opf.build(config), 2)
+        self.assertEqual(os.listdir(outdir), [])
+        with open(stats) as fr:
+            self.assertEqual(json.load(fr)['output'], output)
+
+    def test_batch_hooks(self):
+        config = self.config()
+        tab2opf.build(config)
+        expected = self.read(config, 'test0.html')
+
+        batches = []
+        def getkeys_batch(terms):
+            batches.append(terms)
+            return [term.lower() for term in terms]
+        mod = types.ModuleType('batchmod')
+        mod.__file__ = 'batchmod.py'
+        mod.getkeys_batch = getkeys_batch
+        with mock.patch.dict('sys.modules', batchmod=mod):
+            config = tab2opf.Config(self.filename, module='batchmod',
+                                    outdir=config.outdir, name='b')
+            tab2opf.build(config)
+        self.assertEqual(batches, [['antaa', 'pöytä', 'talo', 'Talo']])
+        self.assertEqual(self.read(config, 'b0.html'), expected)
+
+    def test_defaultname(self):
+        self.assertEqual(tab2opf.defaultname('a/dict.tab'), 'dict')
+        self.assertEqual(tab2opf.defaultname('dict.tab.gz'), 'dict')
+        self.assertEqual(tab2opf.defaultname('dict.xz'), 'dict')
+        self.assertEqual(tab2opf.defaultname('-'), 'dictionary')
+
+class TestNormalize(unittest.TestCase):
+
+    def test_foldkey(self):
+        mapping = {'ä': 'a', 'Ö': 'O', '&': '+', '<': '<<', 'ß': 'ss'}
+        normalize = tab2opf.normalizetable(mapping)
+        normalizeescape = tab2opf.normalizeescapetable(mapping)
+        rnd = random.Random(0)
+        for _ in range(1000):
+            text = ''.join(rnd.choice(' aäÖöß&<>;Xx\t')
+                           for _ in range(rnd.randint(0, 10)))
+            normalized = ''.join(mapping.get(c, c) for c in text)
+            self.assertEqual(text.translate(normalize), normalized)
+            self.assertEqual(tab2opf.foldkey(text),
+                             escape(text.lower().strip()))
+            self.assertEqual(tab2opf.foldkey(text, normalizeescape),
+                             escape(normalized.lower().strip()))
+
+class TestRender(unittest.TestCase):
+
+    def test_keybytes(self):
+        defn = [
+            tab2opf.Entry('pöytä', 'table', True, 'noun',
+                          (('genetiivi', 'pöydän'),)),
+            tab2opf.Entry('Pöytä', 'desk', False, 'noun'),
+            tab2opf.Entry('pöytä', 'board', True, 'noun', ()),
+        ]
+        self.assertEqual(tab2opf.keybytes('pöytä', defn),
+                         len(tab2opf.renderkey('pöytä', defn).encode('utf-8')))
+
+    def test_splitshards(self):
+        groups = [(str(i), [tab2opf.Entry(str(i), 'x', True, 'noun',
+                                          (('a', 'b'),) * i)])
+                  for i in range(10)]
+        shards = list(tab2opf.splitshards(groups, 4))
+        self.assertEqual([len(s) for s in shards], [4, 4, 2])
+        shards = list(tab2opf.splitshards(groups, 100, max_iforms=10))
+        self.assertEqual([[k for k, _ in s] for s in shards],
+                         [['0', '1', '2', '3', '4'], ['5'], ['6'], ['7'],
+                          ['8'], ['9']])
+
+if __name__ == '__main__':
+    unittest.main()